@@ -0,0 +1,232 @@
+"""
+Benchmarks of testmon's hot paths on a generated project.
+
+    python benchmark/bench.py [--modules 50 --functions 20 --tests 2000 --fanout 5] [-o result.json]
+    python benchmark/bench.py --compare before.json after.json
+
+Everything runs locally in a temporary directory. The results (best of --repeat runs,
+in seconds) are printed as JSON, so runs on different commits can be compared.
+The end-to-end benchmarks run ``python -m pytest --testmon`` in a subprocess and need
+the plugin to be installed (pip install -e .), --no-e2e skips them.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from testmon.process_code import Module, checksum_coverage  # noqa
+from testmon.testmon_core import TestmonData  # noqa
+
+
+def module_source(module, functions, variant=0):
+    return "\n\n".join(textwrap.dedent("""\
+        def func_{0}(x):
+            y = x * {0}
+            return y + {1}
+        """).format(function, variant if function == 0 else 0)
+                       for function in range(functions))
+
+
+def test_source(test_module, tests_per_module, calls):
+    imports = sorted(set("from mod_{0} import func_{1} as m{0}_f{1}".format(module, function)
+                         for test_calls in calls for module, function in test_calls))
+    tests = []
+    for test, test_calls in enumerate(calls):
+        tests.append("def test_{}_{}():\n{}".format(
+            test_module, test,
+            "".join("    assert m{0}_f{1}(1) is not None\n".format(module, function)
+                    for module, function in test_calls)))
+    return "\n".join(imports) + "\n\n\n" + "\n\n".join(tests)
+
+
+class Project(object):
+    """Generated project: `modules` modules with `functions` functions each and `tests`
+    tests in modules of 50, every test calls `fanout` random functions."""
+
+    def __init__(self, directory, modules, functions, tests, fanout, seed=0):
+        self.directory = directory
+        self.modules = modules
+        self.functions = functions
+        rng = random.Random(seed)
+        self.calls = [[(rng.randrange(modules), rng.randrange(functions)) for _ in range(fanout)]
+                      for _ in range(tests)]
+        for module in range(modules):
+            self.write('mod_{}.py'.format(module), module_source(module, functions))
+        tests_per_module = 50
+        for test_module, start in enumerate(range(0, tests, tests_per_module)):
+            self.write('test_{}.py'.format(test_module),
+                       test_source(test_module, tests_per_module, self.calls[start:start + tests_per_module]))
+        self.nodeids = ['test_{}.py::test_{}_{}'.format(test // tests_per_module, test // tests_per_module,
+                                                        test % tests_per_module)
+                        for test in range(tests)]
+
+    def write(self, filename, source):
+        with open(os.path.join(self.directory, filename), 'w') as f:
+            f.write(source)
+
+    def change(self, count, variant=1):
+        """Change the first function of `count` modules."""
+        for module in range(count):
+            self.write('mod_{}.py'.format(module), module_source(module, self.functions, variant))
+            path = os.path.join(self.directory, 'mod_{}.py'.format(module))
+            os.utime(path, (time.time() + variant, time.time() + variant))
+
+    def parsed(self):
+        return dict(('mod_{}.py'.format(module), Module(file_name='mod_{}.py'.format(module),
+                                                        rootdir=self.directory))
+                    for module in range(self.modules))
+
+    def node_data(self, modules):
+        """Dependencies as the plugin would record them (line 2 of the called functions)."""
+        result = {}
+        for nodeid, test_calls in zip(self.nodeids, self.calls):
+            lines = {}
+            for module, function in test_calls:
+                lines.setdefault('mod_{}.py'.format(module), set()).add(function * 5 + 2)
+            result[nodeid] = dict((filename, checksum_coverage(modules[filename].table, file_lines))
+                                  for filename, file_lines in lines.items())
+        return result
+
+
+def best(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def run_pytest(directory):
+    """pytest exits with 5 when testmon deselected all the tests."""
+    command = [sys.executable, '-m', 'pytest', '--testmon', '-q', '-p', 'no:cacheprovider']
+    process = subprocess.Popen(command, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode not in (0, 5):
+        raise subprocess.CalledProcessError(process.returncode, command, output=output)
+
+
+def benchmark(args):
+    results = {}
+    directory = tempfile.mkdtemp(prefix='testmon-bench-')
+    try:
+        project = Project(directory, args.modules, args.functions, args.tests, args.fanout)
+        modules = project.parsed()
+        node_data = project.node_data(modules)
+
+        results['module_parse'] = best(project.parsed, args.repeat)
+
+        blocks_lines = [(modules[filename].table, [line for line in range(1, 5 * args.functions, 3)])
+                        for filename in modules]
+        results['checksum_coverage'] = best(lambda: [checksum_coverage(blocks, lines)
+                                                     for blocks, lines in blocks_lines], args.repeat)
+
+        project.change(1)
+        changed = {'mod_0.py': Module(file_name='mod_0.py', rootdir=directory)}
+
+        testmon_data = TestmonData(directory, flush_interval=0)
+        start = time.time()
+        for nodeid in project.nodeids:
+            testmon_data.set_dependencies(nodeid, node_data[nodeid])
+        results['set_dependencies_per_test'] = (time.time() - start) / len(project.nodeids)
+        testmon_data.connection.close()
+        os.remove(testmon_data.datafile)
+
+        testmon_data = TestmonData(directory, flush_interval=3600)
+        start = time.time()
+        for nodeid in project.nodeids:
+            testmon_data.set_dependencies(nodeid, node_data[nodeid])
+        testmon_data.flush()
+        results['set_dependencies_per_test_batched'] = (time.time() - start) / len(project.nodeids)
+
+        results['fetch_node_data'] = best(testmon_data._fetch_node_data, args.repeat)
+
+        def compute_unaffected(lazy):
+            testmon_data.read_data(lazy=lazy)
+            testmon_data.compute_unaffected(changed)
+
+        results['compute_unaffected'] = best(lambda: compute_unaffected(False), args.repeat)
+        results['compute_unaffected_lazy'] = best(lambda: compute_unaffected(True), args.repeat)
+        testmon_data.connection.close()
+
+        if not args.no_e2e:
+            shutil.rmtree(directory)
+            os.mkdir(directory)
+            project = Project(directory, args.modules, args.functions, args.tests, args.fanout)
+            try:
+                run_pytest(directory)
+                results['pytest_testmon_nothing_changed'] = best(lambda: run_pytest(directory), args.repeat)
+                variants = iter(range(1, 1000))
+                results['pytest_testmon_one_changed'] = best(
+                    lambda: (project.change(1, next(variants)), run_pytest(directory)), args.repeat)
+                results['pytest_testmon_many_changed'] = best(
+                    lambda: (project.change(args.modules // 2, next(variants)), run_pytest(directory)),
+                    args.repeat)
+            except subprocess.CalledProcessError as e:
+                results['pytest_testmon_error'] = e.output.decode('utf-8', 'replace')[-2000:]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def git_commit():
+    try:
+        # keep "fatal: not a git repository" out of the report
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_file, after_file):
+    with open(before_file) as f:
+        before = json.load(f)['results']
+    with open(after_file) as f:
+        after = json.load(f)['results']
+    for name in sorted(set(before) & set(after)):
+        if isinstance(before[name], float) and isinstance(after[name], float) and before[name]:
+            print("{:40} {:12.6f} {:12.6f} {:8.2f}x".format(name, before[name], after[name],
+                                                            after[name] / before[name]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modules', type=int, default=50)
+    parser.add_argument('--functions', type=int, default=20, help="functions per module")
+    parser.add_argument('--tests', type=int, default=2000)
+    parser.add_argument('--fanout', type=int, default=5, help="functions called by every test")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-e2e', action='store_true', help="skip pytest --testmon runs")
+    parser.add_argument('-o', '--output', help="write the JSON result to this file")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="compare two result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = {'commit': git_commit(),
+              'python': sys.version.split()[0],
+              'params': {'modules': args.modules, 'functions': args.functions, 'tests': args.tests,
+                         'fanout': args.fanout, 'repeat': args.repeat},
+              'results': benchmark(args)}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
-import pytest
+import shutil
+import tempfile
 from collections import namedtuple
 
-from testmon.process_code import Module
+import pytest
+
+from testmon.process_code import Module, CHECKSUM_VERSION
 from test.test_process_code import CodeSample
-from testmon.testmon_core import TestmonData as CoreTestmonData, SourceTree, flip_dictionary, unaffected, \
-    read_file_with_checksum
+from testmon.testmon_core import TestmonData as CoreTestmonData, SourceTree, flip_dictionary, \
+    read_file_with_checksum, GitState, git, DependencyBitsets, to_bitset, bit_positions, \
+    pack_checksums
 
 pytest_plugins = "pytester",
 
@@ -40,6 +44,303 @@ def test_write_read_data2(testdir):
     assert td2.node_data['n1'] == n1_node_data
 
 
+@pytest.mark.parametrize('lazy', [False, True])
+def test_compute_unaffected_from_index(testdir, lazy):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101, 102, 104], 'test_a.py': [201]})
+    td.set_dependencies('n2', {'a.py': [101], 'test_b.py': [301]})
+    td.set_dependencies('n3', {'a.py': [102], 'b.py': [401]})
+    with td.connection:
+        td._write_fingerprints(dict((name, (1.0, name)) for name in ['a.py', 'test_a.py', 'test_b.py', 'b.py']))
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td2.read_data(lazy=lazy)
+    td2.compute_unaffected(blockify({'a.py': [101, 103]}))
+    assert td2.unaffected_nodeids == {'n2'}
+    assert td2.unaffected_files == {'test_b.py'}
+    assert td2.changed_blocks == {'n1': 2, 'n3': 1}
+
+
+def test_index_replaced_on_rerun(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101, 102]})
+    td.set_dependencies('n1', {'a.py': [101]})
+    td.read_data()
+    td.compute_unaffected(blockify({'a.py': [101]}))
+    assert td.unaffected_nodeids == {'n1'}
+
+
+def test_buffered_dependencies(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default', flush_interval=3600)
+    td.set_dependencies('n1', {'a.py': [101]})
+    td.set_dependencies('n2', {'a.py': [102]}, [{'outcome': 'failed'}])
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td2.read_data()
+    assert td2.node_data == {}
+    td.flush()
+    td2.read_data()
+    assert td2.node_data == {'n1': {'a.py': [101]}, 'n2': {'a.py': [102]}}
+    assert td2.fail_reports['n2'] == [{'outcome': 'failed'}]
+
+
+def test_xdist_state(testdir):
+    testdir.makepyfile(a="""\
+    def f():
+        return 1
+    """)
+    controller = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    controller.set_dependencies('n1', {'a.py': [101]})
+    controller.set_dependencies('n2', {'b.py': [201]})
+    with controller.connection:
+        controller._write_fingerprints({'a.py': (1.0, 'a'), 'b.py': (1.0, 'b')})
+    controller.read_data()
+    controller.compute_unaffected(blockify({'a.py': [102]}))
+
+    worker = CoreTestmonData(testdir.tmpdir.strpath, 'default', flush_interval=float('inf'))
+    worker.read_data(lazy=True)
+    worker.load_xdist_state(controller.xdist_state())
+    assert not worker.test_should_run('n2')
+    assert worker.test_should_run('n1')
+    assert worker.unaffected_files == {'b.py'}
+    assert worker.source_tree.get_file('a.py').checksums == Module(file_name='a.py',
+                                                                   rootdir=testdir.tmpdir.strpath).checksums
+    worker.set_dependencies('n1', {'a.py': [102]})
+    assert worker.pending_dependencies == [('n1', {'a.py': [102]}, [])]
+
+
+def test_checksum_version_change(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101]})
+    with td.connection:
+        td.connection.execute("UPDATE metadata SET data='1' WHERE dataid='checksum_version'")
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td2.read_data()
+    assert td2.node_data == {}
+
+
+def test_lazy_node_data(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101, 102]})
+    td.set_dependencies('n2', {'b.py': [201]})
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td2.read_data(lazy=True)
+    assert set(td2.node_data) == {'n1', 'n2'}
+    assert td2.node_data.cache == {}
+    td2.compute_unaffected(blockify({'a.py': [101]}))
+    assert td2.unaffected_nodeids == {'n2'}
+    assert set(td2.node_data.cache) == {'n1'}
+    assert td2.node_data['n2'] == {'b.py': [201]}
+    assert 'n3' not in td2.node_data
+
+
+def test_collect_garbage(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101]})
+    td.set_dependencies('n2', {'a.py': [101]})
+    td.read_data()
+    with td.connection:
+        td.collect_garbage(['n1'])
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td2.read_data()
+    assert set(td2.node_data) == {'n2'}
+
+
+def test_module_nodeids(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('test_a.py::test_1', {'a.py': [101], 'test_a.py': [1]})
+    td.set_dependencies('test_a.py::TestA::test_2', {'test_a.py': [2]})
+    td.set_dependencies('pkg/check_b.py::test_3', {'a.py': [101], 'pkg/check_b.py': [3]})
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    assert dict(td2.module_nodeids()) == {'test_a.py': ['test_a.py::test_1', 'test_a.py::TestA::test_2'],
+                                          'pkg/check_b.py': ['pkg/check_b.py::test_3']}
+    assert sorted(td2.file_nodeids()['a.py']) == ['pkg/check_b.py::test_3', 'test_a.py::test_1']
+    td2.read_data()
+    td2.collect_garbage(['test_a.py::test_1'])
+    assert td2.module_nodeids()['test_a.py'] == ['test_a.py::TestA::test_2']
+
+
+def test_upgrade_denormalized_tables(testdir):
+    import sqlite3
+    connection = sqlite3.connect(testdir.tmpdir.join('.testmondata').strpath)
+    connection.execute('CREATE TABLE metadata (dataid TEXT PRIMARY KEY, data TEXT)')
+    connection.execute('CREATE TABLE node (variant TEXT, name TEXT, result TEXT, failed BIT, '
+                       'PRIMARY KEY (variant, name))')
+    connection.execute('CREATE TABLE node_file (node_variant TEXT, node_name TEXT, file_name TEXT, checksums TEXT)')
+    connection.execute("INSERT INTO metadata VALUES ('default:mtimes', '{\"a.py\": 1.0}')")
+    connection.execute("INSERT INTO metadata VALUES ('checksum_version', ?)", (str(CHECKSUM_VERSION),))
+    connection.execute("INSERT INTO node VALUES ('default', 'n1', '', 0)")
+    connection.execute("INSERT INTO node VALUES ('default', 'n2', '', 0)")
+    connection.execute("INSERT INTO node_file VALUES ('default', 'n1', 'a.py', '[101, 102]')")
+    connection.execute("INSERT INTO node_file VALUES ('default', 'n1', 'a.py', '[101, 103]')")
+    connection.execute("INSERT INTO node_file VALUES ('default', 'n2', 'b.py', '[201, -202]')")
+    connection.commit()
+    connection.close()
+
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.read_data()
+    assert td.node_data == {'n1': {'a.py': [101, 103]}, 'n2': {'b.py': [201, 2 ** 32 - 202]}}
+    assert td._fetch_fingerprints() == {'a.py': (1.0, None)}
+    assert td._fetch_attribute('mtimes') is None
+    td.compute_unaffected(blockify({'a.py': [101]}))
+    assert td.unaffected_nodeids == {'n2'}
+
+
+def test_upgrade_baseline_data(testdir):
+    """Data written by python 2 has signed adler32 checksums of checksum version 1."""
+    import sqlite3
+    connection = sqlite3.connect(testdir.tmpdir.join('.testmondata').strpath)
+    connection.execute('CREATE TABLE metadata (dataid TEXT PRIMARY KEY, data TEXT)')
+    connection.execute('CREATE TABLE node (variant TEXT, name TEXT, result TEXT, failed BIT, '
+                       'PRIMARY KEY (variant, name))')
+    connection.execute('CREATE TABLE node_file (node_variant TEXT, node_name TEXT, file_name TEXT, checksums TEXT)')
+    connection.execute("INSERT INTO metadata VALUES ('default:mtimes', '{\"a.py\": 1.0}')")
+    connection.execute("INSERT INTO node VALUES ('default', 'n1', '', 0)")
+    connection.execute("INSERT INTO node_file VALUES ('default', 'n1', 'a.py', '[-1795155945, 102]')")
+    connection.commit()
+    connection.close()
+
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.read_data()
+    assert td.node_data == {}
+    assert td._fetch_fingerprints() == {'a.py': (1.0, None)}
+
+
+def test_fingerprints_written_when_changed(testdir):
+    testdir.makepyfile(a="a = 1", b="b = 1")
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.read_source()
+    td.source_tree.get_file('a.py')
+    td.source_tree.get_file('b.py')
+    td.write_data()
+    fingerprints = td._fetch_fingerprints()
+    assert fingerprints['a.py'] == (testdir.tmpdir.join('a.py').mtime(), read_file_with_checksum(
+        testdir.tmpdir.join('a.py').strpath)[1])
+
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td2.read_source()
+    testdir.makepyfile(b="b = 2")
+    testdir.tmpdir.join('b.py').setmtime(1424880936)
+    td2.source_tree.get_changed_files()
+    written = []
+    td2._write_fingerprints = written.append
+    td2.write_data()
+    assert written == [{'b.py': (1424880936, read_file_with_checksum(testdir.tmpdir.join('b.py').strpath)[1])}]
+
+
+def create_old_data(path, version, dependencies):
+    """.testmondata of data version 4 to 6, when node_file held the checksums of every node."""
+    import sqlite3
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE metadata (dataid TEXT PRIMARY KEY, data TEXT)')
+    connection.execute("INSERT INTO metadata VALUES ('checksum_version', ?)", (str(CHECKSUM_VERSION),))
+    connection.execute('CREATE TABLE node (id INTEGER PRIMARY KEY, variant TEXT, name TEXT, result TEXT, '
+                       'failed BIT, {}UNIQUE (variant, name))'.format('duration REAL, ' if version >= 5 else ''))
+    connection.execute('CREATE TABLE file (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+    connection.execute('CREATE TABLE node_file (node_id INTEGER REFERENCES node(id) ON DELETE CASCADE, '
+                       'file_id INTEGER REFERENCES file(id), checksums BLOB, PRIMARY KEY (node_id, file_id))')
+    connection.execute('CREATE TABLE node_block (file_id INTEGER, checksum INTEGER, '
+                       'node_id INTEGER REFERENCES node(id) ON DELETE CASCADE)')
+    connection.execute('CREATE TABLE file_blocks (checksum TEXT PRIMARY KEY, blocks TEXT)')
+    if version >= 6:
+        connection.execute('CREATE TABLE file_fingerprint (variant TEXT, name TEXT, mtime REAL, checksum TEXT, '
+                           'PRIMARY KEY (variant, name))')
+    for nodeid, node_files in sorted(dependencies.items()):
+        node_id = connection.execute("INSERT INTO node (variant, name, result, failed) "
+                                     "VALUES ('default', ?, '', 0)", (nodeid,)).lastrowid
+        for filename, checksums in node_files.items():
+            connection.execute("INSERT OR IGNORE INTO file (name) VALUES (?)", (filename,))
+            file_id = connection.execute("SELECT id FROM file WHERE name=?", (filename,)).fetchone()[0]
+            connection.execute("INSERT INTO node_file VALUES (?, ?, ?)", (node_id, file_id, pack_checksums(checksums)))
+            connection.executemany("INSERT INTO node_block VALUES (?, ?, ?)",
+                                   [(file_id, checksum, node_id) for checksum in checksums])
+    connection.execute("PRAGMA user_version = {}".format(version))
+    return connection
+
+
+def test_unrecorded_files_not_unaffected(testdir):
+    testdir.makepyfile(test_a="def test_a():\n    pass\n")
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('test_a.py::test_a', {'test_a.py': [1]})
+    td.read_data()
+    td.read_source()
+    assert td.unaffected_nodeids == {'test_a.py::test_a'}
+    assert td.unaffected_files == set()
+
+    td.source_tree.get_file('test_a.py')
+    td.write_data()
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td2.read_data()
+    td2.read_source()
+    assert td2.unaffected_files == {'test_a.py'}
+
+
+def test_upgrade_fingerprints(testdir):
+    connection = create_old_data(testdir.tmpdir.join('.testmondata').strpath, 5, {})
+    connection.execute("INSERT INTO metadata VALUES ('V1:mtimes', '{\"a.py\": 1.0}')")
+    connection.execute("INSERT INTO metadata VALUES ('V1:file_checksums', '{\"a.py\": \"abc\"}')")
+    connection.commit()
+    connection.close()
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'V1')
+    assert td._fetch_fingerprints() == {'a.py': (1.0, 'abc')}
+    assert td._fetch_attribute('mtimes') is None
+
+
+def test_durations(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101]}, [{'when': 'setup', 'duration': 0.5},
+                                                {'when': 'call', 'duration': 2.0}])
+    td.set_dependencies('n2', {'a.py': [101]})
+    assert CoreTestmonData(testdir.tmpdir.strpath, 'default').get_durations() == {'n1': 2.5}
+
+
+def test_upgrade_adds_duration(testdir):
+    connection = create_old_data(testdir.tmpdir.join('.testmondata').strpath, 4, {'n1': {'a.py': [101]}})
+    connection.commit()
+    connection.close()
+
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.read_data()
+    assert td.node_data == {'n1': {'a.py': [101]}}
+    td.set_dependencies('n1', {'a.py': [101]}, [{'duration': 1.0}])
+    assert td.get_durations() == {'n1': 1.0}
+
+
+def test_upgrade_dependency_sets(testdir):
+    dependencies = {'n1': {'a.py': [101, 102]}, 'n2': {'a.py': [101, 102]}, 'n3': {'b.py': [201]}}
+    connection = create_old_data(testdir.tmpdir.join('.testmondata').strpath, 6, dependencies)
+    connection.commit()
+    connection.close()
+
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.read_data()
+    assert td.node_data == dependencies
+    assert td.connection.execute("SELECT COUNT(*) FROM dependency_set").fetchone()[0] == 2
+    td.compute_unaffected(blockify({'a.py': [101]}))
+    assert td.unaffected_nodeids == {'n3'}
+
+
+def test_dependency_sets_shared(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    for i in range(3):
+        td.set_dependencies('test_a.py::test_x[{}]'.format(i), {'a.py': [101], 'test_a.py': [1]})
+    td.set_dependencies('test_a.py::test_y', {'test_a.py': [2]})
+    count = lambda table: td.connection.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+    assert (count('dependency_set'), count('dependency_file')) == (2, 3)
+
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td2.read_data()
+    assert td2.node_data['test_a.py::test_x[0]'] is td2.node_data['test_a.py::test_x[2]']
+    [x_file] = [name for name in td2.node_data['test_a.py::test_x[0]'] if name == 'test_a.py']
+    [y_file] = list(td2.node_data['test_a.py::test_y'])
+    assert x_file is y_file
+    td2.read_data(lazy=True)
+    assert td2.node_data['test_a.py::test_x[0]'] is td2.node_data['test_a.py::test_x[1]']
+
+    td.set_dependencies('test_a.py::test_y', {'test_a.py': [3]})
+    assert count('dependency_set') == 2
+    td.collect_garbage(['test_a.py::test_x[{}]'.format(i) for i in range(3)])
+    assert (count('dependency_set'), count('dependency_file'), count('dependency_block')) == (1, 1, 1)
+
+
 class TestDepGraph():
     def test_dep_graph1(self):
         assert is_dependent({'a.py': [101, 102]}, {'a.py': [101, 102, 3]}) == False
@@ -127,21 +428,34 @@ class TestDepGraph():
         assert affected_nodeids(dependencies, changes) == {'node1'}
 
 
-class TestUnaffected():
-    def test_nothing_changed(self):
-        changed = {'a.py': [101, 102, 103]}
-        dependencies = {'node1': {'test_a.py': [201, 202], 'a.py': [101, 102, 103]}}
-        assert unaffected(dependencies, blockify(changed))[0] == dependencies
-
-    def test_simple_change(self):
-        changed = {'a.py': [101, 102, 151]}
-        dependencies = {'node1': {'test_a.py': [201, 202], 'a.py': [101, 102, 103]},
-                        'node2': {'test_b.py': [301, 302], 'a.py': [151]}}
+def test_bitsets():
+    assert to_bitset([]) == 0
+    assert to_bitset([0, 9, 70]) == (1 << 0) | (1 << 9) | (1 << 70)
+    assert list(bit_positions(to_bitset([70, 0, 9]))) == [0, 9, 70]
+    assert list(bit_positions(0)) == []
 
-        nodes, files = unaffected(dependencies, blockify(changed))
 
-        assert set(nodes) == {'node2'}
-        assert set(files) == {'test_b.py'}
+def test_dependency_bitsets(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101, 102]})
+    td.set_dependencies('n2', {'a.py': [102], 'b.py': [201]})
+    td.set_dependencies('n3', {'b.py': [202]})
+    set_ids = dict(td.connection.execute("SELECT name, dependency_set_id FROM node"))
+    a, b = td._file_id('a.py'), td._file_id('b.py')
+    bitsets = DependencyBitsets(td.connection)
+    assert bitsets.affected({a: [102]}) == to_bitset([set_ids['n1']])
+    assert set(bitsets.bitsets) == {a}
+    assert bitsets.affected({a: [], b: [201]}) == to_bitset(set_ids.values())
+    assert set(bitsets.bitsets) == {a, b}
+    assert bitsets.changed_blocks({a: [], b: [201]}) == {set_ids['n1']: 2, set_ids['n2']: 1, set_ids['n3']: 1}
+
+
+def test_affected_nodeids_of_variant(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'V1')
+    td.set_dependencies('n1', {'a.py': [101]})
+    td2 = CoreTestmonData(testdir.tmpdir.strpath, 'V2')
+    td2.set_dependencies('n2', {'a.py': [101]})
+    assert td2.affected_nodeids(blockify({'a.py': [102]})) == {'n2': 1}
 
 
 def get_modules(checksums):
@@ -154,8 +468,17 @@ def is_dependent(dependencies, changes):
 
 
 def affected_nodeids(dependencies, changes):
-    unaffected_nodes, files = unaffected(dependencies, blockify(changes))
-    return set(dependencies) - set(unaffected_nodes)
+    rootdir = tempfile.mkdtemp()
+    try:
+        td = CoreTestmonData(rootdir)
+        for nodeid, node_files in dependencies.items():
+            td.set_dependencies(nodeid, node_files)
+        td.read_data()
+        td.compute_unaffected(blockify(changes))
+        td.connection.close()
+        return set(dependencies) - td.unaffected_nodeids
+    finally:
+        shutil.rmtree(rootdir)
 
 
 def blockify(changes):
@@ -255,6 +578,89 @@ class TestSourceTree():
         fs_data.mtimes['a.py'] = a_py.mtime
         fs_data.checksums['a.py'] = 'ec1fd361d4d73353c3f65cb10b86fcea4e0d0e42'
 
+    def test_parallel(self, testdir, a_py):
+        testdir.makepyfile(b="""
+        def test_b():
+            return 1
+        """, c="""
+        def test_c():
+            return 2
+        """)
+        code, checksum = read_file_with_checksum('a.py')
+        mtimes = {'a.py': -100, 'b.py': -100, 'c.py': -100, 'd.py': -100}
+        checksums = {'a.py': checksum}
+        serial = SourceTree(rootdir=testdir.tmpdir.strpath, mtimes=dict(mtimes), checksums=dict(checksums))
+        parallel = SourceTree(rootdir=testdir.tmpdir.strpath, mtimes=dict(mtimes), checksums=dict(checksums),
+                              workers=3)
+        serial_changed = serial.get_changed_files()
+        parallel_changed = parallel.get_changed_files()
+        assert sorted(parallel_changed) == ['b.py', 'c.py']
+        assert parallel_changed['b.py'].checksums == serial_changed['b.py'].checksums
+        assert parallel_changed['c.py'].checksums == serial_changed['c.py'].checksums
+        assert parallel.mtimes == serial.mtimes
+        assert parallel.checksums == serial.checksums
+
+    def test_block_cache(self, testdir, a_py, monkeypatch):
+        td = CoreTestmonData(testdir.tmpdir.strpath)
+        td.read_source()
+        blocks = td.source_tree.get_file('a.py').blocks
+        td.write_data()
+
+        def parse_file(*args, **kwargs):
+            raise AssertionError("a.py didn't change, it shouldn't be parsed again")
+
+        monkeypatch.setattr('testmon.testmon_core.parse_file', parse_file)
+        td2 = CoreTestmonData(testdir.tmpdir.strpath)
+        td2.read_source()
+        assert td2.source_tree.get_file('a.py').blocks == blocks
+
+    def test_block_cache_keeps_reverted_versions(self, testdir, a_py, monkeypatch):
+        def run():
+            td = CoreTestmonData(testdir.tmpdir.strpath)
+            td.read_source()
+            blocks = td.source_tree.get_file('a.py').blocks
+            td.write_data()
+            return td, blocks
+
+        blocks = run()[1]
+        original = a_py.read()
+        a_py.write(original + "\ndef test_b():\n    pass\n")
+        a_py.setmtime(a_py.mtime() + 10)
+        td = run()[0]
+        a_py.write(original)
+        a_py.setmtime(a_py.mtime() + 10)
+
+        def parse_file(*args, **kwargs):
+            raise AssertionError("a.py went back to a cached version, it shouldn't be parsed again")
+
+        monkeypatch.setattr('testmon.testmon_core.parse_file', parse_file)
+        assert run()[1] == blocks
+
+        td.connection.execute("UPDATE file_blocks SET used = 0")
+        td.connection.commit()
+        monkeypatch.undo()
+        run()
+        # only the blocks of the current version of a.py are left
+        assert td.connection.execute("SELECT COUNT(*) FROM file_blocks").fetchone()[0] == 1
+
+    def test_block_cache_per_python_version(self, testdir, a_py, monkeypatch):
+        td = CoreTestmonData(testdir.tmpdir.strpath)
+        td.read_source()
+        td.write_data()
+        a_py.setmtime(a_py.mtime() + 10)
+        parsed = []
+
+        def parse_file(filename, rootdir, source_code):
+            parsed.append(filename)
+            return Module.from_blocks([])
+
+        monkeypatch.setattr('testmon.testmon_core.parse_file', parse_file)
+        monkeypatch.setattr('testmon.testmon_core.PYTHON_VERSION', 'OtherPython 1.0.0')
+        td2 = CoreTestmonData(testdir.tmpdir.strpath)
+        td2.read_source()
+        td2.source_tree.get_file('a.py')
+        assert parsed == ['a.py']
+
     def test_disappeared(self, testdir, a_py):
         fs_data = SourceTree(rootdir=testdir.tmpdir.strpath, mtimes={'b.py': -100}, checksums={'b.py': -200})
         fs_data.get_changed_files()
@@ -263,3 +669,31 @@ class TestSourceTree():
 
 
         # parse_fs_changes(stored_version={'a.py': [a_py.mtime, hash(a_py.read_mtime)]})
+
+
+class TestGitState():
+    @pytest.fixture
+    def repo(self, testdir):
+        testdir.makepyfile(a="a = 1", b="b = 1", c="c = 1")
+        git(testdir.tmpdir.strpath, 'init', '-q')
+        git(testdir.tmpdir.strpath, 'add', 'a.py', 'b.py')
+        git(testdir.tmpdir.strpath, '-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q', '-m', '1')
+        return testdir
+
+    def test_not_a_repository(self, testdir, monkeypatch):
+        monkeypatch.setenv('GIT_CEILING_DIRECTORIES', testdir.tmpdir.dirname)
+        assert GitState.read(testdir.tmpdir.strpath) is None
+
+    def test_candidates(self, repo):
+        rootdir = repo.tmpdir.strpath
+        state = GitState.read(rootdir)
+        assert state.dirty == {'c.py'}
+        assert state.candidates(state.head, [], ['a.py', 'b.py', 'c.py']) == {'c.py'}
+
+        repo.makepyfile(b="b = 2")
+        git(rootdir, '-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q', '-a', '-m', '2')
+        repo.makepyfile(a="a = 2")
+        new_state = GitState.read(rootdir)
+        assert new_state.dirty == {'a.py', 'c.py'}
+        assert new_state.candidates(state.head, ['d.py'], ['a.py', 'b.py', 'c.py']) == {'a.py', 'b.py',
+                                                                                        'c.py', 'd.py'}
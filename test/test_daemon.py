@@ -0,0 +1,78 @@
+import os
+import stat
+import sys
+import threading
+
+import pytest
+
+from testmon.testmon_core import TestmonData as CoreTestmonData
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason="inotify is Linux only")
+
+pytest_plugins = "pytester",
+
+
+@pytest.fixture
+def daemon(request, testdir):
+    from testmon.daemon import Daemon
+    daemon = Daemon(testdir.tmpdir.strpath)
+    request.addfinalizer(daemon.close)
+    return daemon
+
+
+def test_changes(testdir, daemon):
+    answer = daemon.answer({'daemon': None, 'generation': 0})
+    assert answer['files'] is None
+
+    testdir.makepyfile(a="""
+        def add(a, b):
+            return a + b
+    """)
+    testdir.tmpdir.mkdir('sub')
+    daemon.process_events()
+    testdir.tmpdir.join('sub', 'b.py').write("b = 1\n")
+    testdir.tmpdir.join('sub', 'data.txt').write("1")
+
+    answer = daemon.answer({'daemon': answer['daemon'], 'generation': answer['generation']})
+    assert sorted(answer['files']) == ['a.py', 'sub/b.py']
+    assert [tuple(block[:2]) for block in answer['files']['a.py']['blocks']] == [(2, 2), (1, 2)]
+
+    testdir.tmpdir.join('sub', 'b.py').remove()
+    answer = daemon.answer({'daemon': answer['daemon'], 'generation': answer['generation']})
+    assert answer['files'] == {}
+
+
+def read_source(testdir, daemon):
+    server = threading.Thread(target=daemon.handle_client)
+    server.start()
+    td = CoreTestmonData(testdir.tmpdir.strpath)
+    td.read_source(use_daemon=True)
+    server.join()
+    return td
+
+
+def test_socket_path(testdir, monkeypatch):
+    from testmon import daemon
+    assert daemon.socket_path(testdir.tmpdir.strpath) == testdir.tmpdir.join('.testmondaemon').strpath
+
+    monkeypatch.setattr(daemon.tempfile, 'gettempdir', lambda: testdir.tmpdir.strpath)
+    long_path = testdir.tmpdir.join('x' * daemon.MAX_SOCKET_PATH).strpath
+    path = daemon.socket_path(long_path)
+    assert os.path.dirname(path) == testdir.tmpdir.join('testmon-{}'.format(os.getuid())).strpath
+    assert stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode) == 0o700
+
+    os.chmod(os.path.dirname(path), 0o777)
+    with pytest.raises(OSError):
+        daemon.socket_path(long_path)
+
+
+def test_read_source(testdir, daemon):
+    a = testdir.makepyfile(a="a = 1")
+    td = read_source(testdir, daemon)
+    td.source_tree.get_file('a.py')
+    td.write_data()
+
+    a.write("a = 2")
+    td = read_source(testdir, daemon)
+    assert list(td.source_tree.changed_files) == ['a.py']
+    assert td.daemon_state['id'] == daemon.id
@@ -1,5 +1,7 @@
 from test.coveragepy.coveragetest import CoverageTest
 
+import zlib
+
 import pytest
 from testmon.process_code import Block, Module, checksum_coverage
 
@@ -115,6 +117,24 @@ class TestchecksumCoverage(object):
     def test_miss_both(self, lines):
         assert checksum_coverage([GLOBAL_BLOCK, Block(2, 3, 101), Block(5, 6, 102)], lines) == [1000, ]
 
+    def test_nested(self):
+        assert checksum_coverage([GLOBAL_BLOCK, Block(2, 7, 101), Block(3, 4, 102)], [6]) == [1000, 101]
+
+    def test_module_table(self):
+        module = Module("""\
+            def f():
+                return 1
+            """)
+        assert module.table is module.table
+        assert checksum_coverage(module.table, [2]) == checksum_coverage(module.blocks, [2])
+        assert sorted(checksum_coverage(module.table, [2])) == sorted(module.checksums)
+
+
+def test_block_checksum_computed_once():
+    block = Block(1, 2, code='def f(): pass')
+    assert not hasattr(block, '__dict__')
+    assert block.checksum == zlib.adler32(b'def f(): pass') & 0xffffffff
+
 
 class CodeSample():
     def __init__(self, source_code, expected_coverage=None, possible_lines=None):
@@ -0,0 +1,36 @@
+from testmon.scheduling import estimates, longest_first, partition, riskiest_first
+
+
+def test_estimates_unknown_as_average():
+    assert estimates(['a', 'b', 'c'], {'a': 1.0, 'b': 3.0}) == {'a': 1.0, 'b': 3.0, 'c': 2.0}
+
+
+def test_estimates_nothing_known():
+    assert estimates(['a', 'b'], {}) == {'a': 0.0, 'b': 0.0}
+
+
+def test_longest_first():
+    assert longest_first(['a', 'b', 'c', 'd'], {'a': 1.0, 'b': 5.0, 'c': 1.0, 'd': 2.0}) == ['b', 'd', 'a', 'c']
+
+
+def test_partition():
+    durations = {'a': 7.0, 'b': 5.0, 'c': 4.0, 'd': 3.0, 'e': 1.0}
+    bins = partition(sorted(durations), durations, 2)
+    assert bins == [['a', 'd'], ['b', 'c', 'e']]
+    assert sorted(sum(durations[nodeid] for nodeid in group) for group in bins) == [10.0, 10.0]
+
+
+def test_partition_without_durations():
+    assert partition(['a', 'b', 'c', 'd', 'e'], {}, 2) == [['a', 'c', 'e'], ['b', 'd']]
+
+
+def test_partition_more_bins_than_tests():
+    assert partition(['a'], {}, 3) == [['a'], [], []]
+
+
+def test_riskiest_first():
+    nodeids = ['a', 'b', 'c', 'd', 'e']
+    assert riskiest_first(nodeids,
+                          failed={'d'},
+                          known={'a', 'b', 'c', 'd'},
+                          changed_blocks={'a': 1, 'b': 3, 'c': 1}) == ['d', 'e', 'b', 'a', 'c']
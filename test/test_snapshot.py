@@ -0,0 +1,234 @@
+import socket
+import threading
+import zlib
+
+import pytest
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:  # python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from testmon.snapshot import export, restore, merge, merge_items, read_snapshot, write_snapshot, main, \
+    DirectoryStore, HTTPStore, ref_key
+from testmon.testmon_core import TestmonData as CoreTestmonData, git
+
+pytest_plugins = "pytester",
+
+
+def commit(rootdir, message):
+    git(rootdir, '-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q', '--allow-empty', '-m', message)
+    return git(rootdir, 'rev-parse', 'HEAD').strip()
+
+
+@pytest.fixture
+def repo(testdir):
+    git(testdir.tmpdir.strpath, 'init', '-q')
+    return testdir
+
+
+class FileServer(BaseHTTPRequestHandler):
+    """In memory stand-in of a shared HTTP store."""
+    files = {}
+
+    def do_GET(self):
+        if self.path in self.files:
+            self.send_response(200)
+            if self.path.endswith('.truncated'):
+                # the connection drops before the announced length was sent
+                self.send_header('Content-Length', str(len(self.files[self.path]) + 100))
+            self.end_headers()
+            self.wfile.write(self.files[self.path])
+        else:
+            self.send_error(404)
+
+    def do_PUT(self):
+        self.files[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_store(request):
+    FileServer.files = {}
+    server = HTTPServer(('127.0.0.1', 0), FileServer)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def fin():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(fin)
+    return HTTPStore('http://127.0.0.1:{}/store'.format(server.server_address[1]))
+
+
+def test_dump_load(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101, 102]}, [{'outcome': 'failed', 'duration': 1.0}])
+    td.set_dependencies('n2', {'b.py': [201]})
+    with td.connection:
+        td._write_attribute('git', {'head': 'abc', 'dirty': []})
+        td._write_fingerprints({'a.py': (1.0, 'abc')})
+    dump = td.dump()
+
+    other = testdir.mkdir('other').strpath
+    td2 = CoreTestmonData(other, 'default')
+    td2.set_dependencies('n3', {'c.py': [301]})
+    td2.load(dump)
+    td2.read_data()
+    assert td2.node_data == {'n1': {'a.py': [101, 102]}, 'n2': {'b.py': [201]}}
+    assert td2.fail_reports['n1'] == [{'outcome': 'failed', 'duration': 1.0}]
+    assert td2.get_durations() == {'n1': 1.0}
+    assert td2._fetch_attribute('git') == {'head': 'abc', 'dirty': []}
+    assert td2._fetch_fingerprints() == {'a.py': (1.0, 'abc')}
+    assert td2.dump() == dump
+
+
+def test_export_restore_nearest_ancestor(repo):
+    rootdir = repo.tmpdir.strpath
+    store = DirectoryStore(repo.tmpdir.join('store').strpath)
+    mainline = commit(rootdir, '1')
+    td = CoreTestmonData(rootdir)
+    td.set_dependencies('n1', {'a.py': [101]})
+    key = export(td, store)
+    assert read_snapshot(store, key)['nodes']['n1']['files'] == {'a.py': [101]}
+
+    commit(rootdir, '2')
+    td.set_dependencies('n2', {'a.py': [101]})
+    assert restore(td, store) == key
+    td.read_data()
+    assert list(td.node_data) == ['n1']
+    assert restore(td, store, commit='unknown') is None
+    assert restore(td, store, commit=mainline) == key
+
+
+def test_http_store(repo, http_store):
+    assert http_store.get('refs/x/y') is None
+    rootdir = repo.tmpdir.strpath
+    commit(rootdir, '1')
+    td = CoreTestmonData(rootdir)
+    assert not td.has_data()
+    td.set_dependencies('n1', {'a.py': [101]})
+    assert td.has_data()
+    key = export(td, http_store)
+    assert '/store/' + key in FileServer.files
+
+    td.connection.close()
+    for datafile in repo.tmpdir.listdir('.testmondata*'):
+        datafile.remove()
+    fresh = CoreTestmonData(rootdir)
+    assert restore(fresh, http_store) == key
+    fresh.read_data()
+    assert fresh.node_data == {'n1': {'a.py': [101]}}
+
+
+def test_http_store_broken_responses(http_store):
+    FileServer.files['/store/objects/a.truncated'] = b'x' * 10
+    with pytest.raises(IOError):
+        http_store.get('objects/a.truncated')
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    try:
+        with pytest.raises(IOError):
+            HTTPStore('http://127.0.0.1:{}'.format(listener.getsockname()[1]), timeout=0.2).get('objects/a')
+    finally:
+        listener.close()
+
+
+def test_main_dangling_ref(repo):
+    store = DirectoryStore(repo.tmpdir.join('store').strpath)
+    store.put(ref_key('default', commit(repo.tmpdir.strpath, '1')), b'objects/gone.json.zlib')
+    with pytest.raises(SystemExit) as excinfo:
+        main(['import', store.path, '--rootdir', repo.tmpdir.strpath])
+    assert 'objects/gone.json.zlib is missing' in str(excinfo.value)
+    with pytest.raises(SystemExit) as excinfo:
+        main(['merge', store.path, '--commit', 'c', 'objects/gone.json.zlib'])
+    assert 'objects/gone.json.zlib is missing' in str(excinfo.value)
+
+
+def test_snapshot_content_addressed(testdir):
+    store = DirectoryStore(testdir.tmpdir.strpath)
+    dump = CoreTestmonData(testdir.tmpdir.strpath).dump()
+    assert write_snapshot(store, dump) == write_snapshot(store, dict(dump))
+
+
+def test_directory_store_replaces_ref(testdir):
+    store = DirectoryStore(testdir.tmpdir.strpath)
+    store.put('refs/x/y', b'objects/1')
+    store.put('refs/x/y', b'objects/2')
+    assert store.get('refs/x/y') == b'objects/2'
+    assert testdir.tmpdir.join('refs', 'x').listdir() == [testdir.tmpdir.join('refs', 'x', 'y')]
+
+
+def test_merge_items():
+    base = {'a': 1, 'b': 1, 'c': 1}
+    assert merge_items([{'a': 2, 'b': 1, 'c': 1}, {'a': 1, 'b': 3, 'c': 1, 'd': 4}], base) == {'a': 2, 'b': 3,
+                                                                                              'c': 1, 'd': 4}
+    assert merge_items([{'a': 1, 'b': 1}, {'a': 1, 'b': 1, 'c': 1}], base) == {'a': 1, 'b': 1}
+    assert merge_items([{'a': 1}, {'a': 2}]) == {'a': 1}
+
+
+def test_merge_shards(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath)
+    td.set_dependencies('n1', {'a.py': [101]})
+    td.set_dependencies('n2', {'b.py': [201]})
+    with td.connection:
+        td._write_fingerprints({'a.py': (1.0, 'a1'), 'b.py': (1.0, 'b1')})
+    base = td.dump()
+
+    td.set_dependencies('n1', {'a.py': [102]})
+    with td.connection:
+        td._write_fingerprints({'a.py': (2.0, 'a2')})
+    shard1 = td.dump()
+    td.load(base)
+    td.set_dependencies('n2', {'b.py': [202]})
+    with td.connection:
+        td._write_fingerprints({'b.py': (2.0, 'b2')})
+    shard2 = td.dump()
+
+    merged = merge([shard1, shard2], base)
+    assert dict((name, node['files']) for name, node in merged['nodes'].items()) == {'n1': {'a.py': [102]},
+                                                                                      'n2': {'b.py': [202]}}
+    assert merged['files'] == {'a.py': [2.0, 'a2'], 'b.py': [2.0, 'b2']}
+
+
+def test_merge_different_variants(testdir):
+    with pytest.raises(ValueError):
+        merge([CoreTestmonData(testdir.tmpdir.strpath, 'V1').dump(),
+               CoreTestmonData(testdir.tmpdir.strpath, 'V2').dump()])
+
+
+def test_main_merge_needs_commit(testdir):
+    with pytest.raises(SystemExit):
+        main(['merge', testdir.tmpdir.strpath, 'snapshot'])
+
+
+@pytest.mark.parametrize('blob', [b'not a snapshot', None, zlib.compress(b'{"variant": "default"}')],
+                         ids=['corrupt', 'missing', 'malformed'])
+def test_pull_broken_snapshot(repo, blob):
+    store = DirectoryStore(repo.tmpdir.join('store').strpath)
+    if blob is not None:
+        store.put('objects/broken.json.zlib', blob)
+    store.put(ref_key('default', commit(repo.tmpdir.strpath, '1')), b'objects/broken.json.zlib')
+    repo.makepyfile(test_a="def test_a():\n    pass\n")
+    result = repo.runpytest_subprocess('--testmon', '--testmon-remote', store.path)
+    result.assert_outcomes(passed=1)
+    assert "can't restore a snapshot from the remote store" in result.stderr.str()
+
+
+def test_load_malformed_dump(testdir):
+    td = CoreTestmonData(testdir.tmpdir.strpath, 'default')
+    td.set_dependencies('n1', {'a.py': [101]})
+    dump = td.dump()
+    del dump['nodes']['n1']['result']
+    with pytest.raises(ValueError):
+        td.load(dump)
+    td.read_data()
+    assert td.node_data == {'n1': {'a.py': [101]}}
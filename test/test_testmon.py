@@ -1,12 +1,16 @@
+import argparse
 import os
 import sys
 
 import pytest
+import coverage
 from test.coveragepy import coveragetest
 from testmon.process_code import Module, checksum_coverage
 from testmon.testmon_core import eval_variant
+from testmon.pytest_testmon import shard
 from testmon.testmon_core import Testmon as CoreTestmon
 from testmon.testmon_core import TestmonData as CoreTestmonData
+from testmon.tracer import Tracer
 from test.test_process_code import CodeSample
 
 pytest_plugins = "pytester",
@@ -78,14 +82,15 @@ def test_run_variant_complex(testdir, monkeypatch):
     assert eval_variant(config.getini('run_variant_expression')) == 'TEST_V:JUST_A_TEST'
 
 
-def track_it(testdir, func):
+def track_it(testdir, func, tracer='coverage'):
     testmon = CoreTestmon(project_dirs=[testdir.tmpdir.strpath],
-                          testmon_labels=set())
+                          testmon_labels=set(), tracer=tracer)
     testmon_data = CoreTestmonData(testdir.tmpdir.strpath)
     testmon_data.read_source()
     testmon.start()
     func()
     testmon.stop_and_save(testmon_data, testdir.tmpdir.strpath, 'testnode')
+    testmon.close()
     return testmon_data._fetch_node_data()[0]['testnode']
 
 
@@ -105,6 +110,33 @@ def test_subprocesss(testdir, monkeypatch):
                 checksum_coverage(Module(file_name=a.strpath).blocks, [2])} == deps
 
 
+def test_subprocess_data_written(testdir):
+    testmon = CoreTestmon(project_dirs=[testdir.tmpdir.strpath], testmon_labels=set())
+    try:
+        assert not testmon.subprocess_data_written()
+        open(testmon.sub_cov_file + '.host.1234.5678', 'w').close()
+        assert testmon.subprocess_data_written()
+    finally:
+        testmon.close()
+
+
+def test_no_combine_without_subprocess(testdir, monkeypatch):
+    testdir.makepyfile(lib="""\
+    def f():
+        return 1
+    """)
+    lib = coveragetest.import_local_file('lib')
+
+    def combine(self, *args, **kwargs):
+        raise AssertionError("combine() called although no subprocess ran")
+
+    monkeypatch.setattr(coverage.Coverage, 'combine', combine)
+    assert track_it(testdir, lib.f)
+    assert track_it(testdir, lib.f, tracer='lines')
+
+    del sys.modules['lib']
+
+
 @pytest.mark.xfail
 def test_subprocess_recursive(testdir, monkeypatch):
     monkeypatch.setenv("PYTHONDONTWRITEBYTECODE", 1)
@@ -150,7 +182,279 @@ def test_run_dissapearing(testdir):
     del sys.modules['a']
 
 
+def test_lines_tracer(testdir):
+    testdir.makepyfile(lib="""\
+    def f(n):
+        total = 0
+        for i in range(n):
+            total += i
+        return total
+
+    def g():
+        return 2
+    """)
+    lib = coveragetest.import_local_file('lib')
+
+    def f():
+        lib.f(10)
+
+    assert track_it(testdir, f, tracer='lines') == track_it(testdir, f)
+    assert track_it(testdir, lib.g, tracer='lines') == track_it(testdir, lib.g)
+    assert track_it(testdir, f, tracer='lines') != track_it(testdir, lib.g, tracer='lines')
+
+    del sys.modules['lib']
+
+
+def test_functions_tracer(testdir):
+    testdir.makepyfile(lib="""\
+    def f(n):
+        total = 0
+        for i in range(n):
+            total += i
+        return total
+
+    @staticmethod
+    def g(): return 2
+    """)
+    lib = coveragetest.import_local_file('lib')
+
+    def f():
+        lib.f(10)
+
+    def g():
+        lib.g.__func__()
+
+    assert track_it(testdir, f, tracer='functions') == track_it(testdir, f)
+    assert track_it(testdir, g, tracer='functions') == track_it(testdir, g)
+    assert track_it(testdir, f, tracer='functions') != track_it(testdir, g, tracer='functions')
+
+    del sys.modules['lib']
+
+
+def test_functions_tracer_decorated_inner_function(testdir):
+    testdir.makepyfile(lib="""\
+    import functools
+
+    def deco(f):
+        @functools.wraps(f)
+        def wrapper(*args):
+            return f(*args)
+        return wrapper
+    """)
+    lib = coveragetest.import_local_file('lib')
+
+    def f():
+        lib.deco(len)
+
+    assert track_it(testdir, f, tracer='functions') == track_it(testdir, f)
+
+    del sys.modules['lib']
+
+
+def test_lines_tracer_one_liners(testdir):
+    testdir.makepyfile(lib="""\
+    def g(): return 2
+
+    h = lambda: 3
+    """)
+    lib = coveragetest.import_local_file('lib')
+    tracer = Tracer(include=[testdir.tmpdir.join('*').strpath], omit=[])
+    try:
+        tracer.start()
+        lib.g()
+        lib.h()
+        tracer.stop()
+    finally:
+        tracer.close()
+    assert tracer.get_data().lines(testdir.tmpdir.join('lib.py').strpath) == [1, 3]
+
+    del sys.modules['lib']
+
+
+def test_settrace_tracer_drops_seen_code(testdir):
+    testdir.makepyfile(lib="""\
+    def f(n):
+        return n + 1
+    """)
+    lib = coveragetest.import_local_file('lib')
+    tracer = Tracer(include=[testdir.tmpdir.join('*').strpath], omit=[])
+    tracer.monitoring = None  # the sys.settrace implementation
+    tracer.start()
+    lib.f(1)
+    tracer.stop()
+    assert tracer.get_data().lines(testdir.tmpdir.join('lib.py').strpath) == [2]
+    assert tracer.remaining[lib.f.__code__] == set()
+
+    del sys.modules['lib']
+
+
+def test_shard_option():
+    assert shard('2/16') == (2, 16)
+    for value in ['0/2', '3/2', '1', 'a/b']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            shard(value)
+
+
 class TestmonDeselect(object):
+    def test_shards(self, testdir):
+        testdir.makepyfile(test_a="""
+            def test_1():
+                pass
+
+            def test_2():
+                pass
+
+            def test_3():
+                pass
+        """)
+        result = testdir.runpytest("--testmon", "--testmon-shard=1/2", "-v")
+        result.stdout.fnmatch_lines(["*test_1 PASSED*", "*test_3 PASSED*", "*2 passed, 1 deselected*"])
+        # every CI node starts from the same .testmondata
+        for datafile in testdir.tmpdir.listdir('.testmondata*'):
+            datafile.remove()
+        result = testdir.runpytest("--testmon", "--testmon-shard=2/2", "-v")
+        result.stdout.fnmatch_lines(["*test_2 PASSED*", "*1 passed, 2 deselected*"])
+
+    def test_interrupted_test_runs_again(self, testdir):
+        testdir.makepyfile(test_a="""
+            import os
+
+            def test_passes():
+                pass
+
+            def test_interrupted():
+                if os.path.exists('interrupt'):
+                    raise KeyboardInterrupt
+        """)
+        testdir.tmpdir.join('interrupt').write('')
+        result = testdir.runpytest_subprocess("--testmon", "-v")
+        result.stdout.fnmatch_lines(["*test_passes PASSED*", "*KeyboardInterrupt*"])
+
+        testdir.tmpdir.join('interrupt').remove()
+        result = testdir.runpytest("--testmon", "-v")
+        result.stdout.fnmatch_lines(["*test_interrupted PASSED*", "*1 passed, 1 deselected*"])
+
+    def test_xdist(self, testdir):
+        pytest.importorskip('xdist')
+        testdir.makepyfile(lib="""
+            def f():
+                return 1
+        """, test_a="""
+            import lib
+
+            def test_1():
+                assert lib.f() == 1
+
+            def test_2():
+                assert False
+        """, test_b="""
+            def test_3():
+                pass
+        """)
+        result = testdir.runpytest_subprocess("--testmon", "-n", "2")
+        result.stdout.fnmatch_lines(["*1 failed, 2 passed*"])
+
+        # the controller wrote the dependencies collected by the workers, nothing is collected and
+        # the failure is replayed by the controller
+        result = testdir.runpytest_subprocess("--testmon", "-n", "2", "-v")
+        result.stdout.fnmatch_lines(["*test_a.py::test_2 FAILED*", "*= 1 failed in*"])
+        assert 'test_1' not in result.stdout.str()
+
+        testdir.makepyfile(lib="""
+            def f():
+                return 2
+        """)
+        result = testdir.runpytest_subprocess("--testmon", "-n", "2", "-v")
+        result.stdout.fnmatch_lines(["*FAILED test_a.py::test_1*"])
+        result.stdout.fnmatch_lines(["*test_a.py::test_2 FAILED*", "*= 2 failed*"])
+        assert 'test_3' not in result.stdout.str()
+
+    def test_xdist_duration_groups(self, testdir):
+        xdist = pytest.importorskip('xdist.scheduler')
+        if not hasattr(xdist, 'LoadGroupScheduling'):
+            pytest.skip("xdist without --dist loadgroup")
+        testdir.makepyfile(lib="""
+            def f():
+                return 1
+        """, test_a="""
+            import time
+            import lib
+
+            def test_slow():
+                time.sleep(0.5)
+                assert lib.f()
+
+            def test_fast1():
+                assert lib.f()
+
+            def test_fast2():
+                assert lib.f()
+
+            def test_fast3():
+                assert lib.f()
+        """)
+        testdir.runpytest("--testmon")
+        testdir.makepyfile(lib="""
+            def f():
+                return 2
+        """)
+        result = testdir.runpytest_subprocess("--testmon", "--testmon-order=duration", "-n", "2",
+                                              "--dist", "loadgroup", "-v")
+        workers = dict((line.split()[-1], line.split()[0]) for line in result.stdout.lines
+                       if line.startswith('[gw') and 'PASSED' in line)
+        assert sorted(workers) == ['test_a.py::test_fast1', 'test_a.py::test_fast2', 'test_a.py::test_fast3',
+                                   'test_a.py::test_slow']
+        assert workers['test_a.py::test_fast1'] == workers['test_a.py::test_fast2'] == \
+            workers['test_a.py::test_fast3'] != workers['test_a.py::test_slow']
+        result = testdir.runpytest("--testmon")
+        result.stdout.fnmatch_lines(["*4 deselected*"])
+
+    def test_python_files_and_directories(self, testdir):
+        testdir.makeini("""
+            [pytest]
+            python_files = check_*.py
+        """)
+        testdir.mkpydir('pkg').join('check_a.py').write("def test_a():\n    pass\n")
+        testdir.makepyfile(check_b="def test_b():\n    pass\n")
+        testdir.runpytest("--testmon")
+        result = testdir.runpytest("--testmon", "-v")
+        result.stdout.fnmatch_lines(["*2 deselected*"])
+
+        testdir.tmpdir.join('pkg', 'check_new.py').write("def test_new():\n    pass\n")
+        result = testdir.runpytest("--testmon", "-v")
+        result.stdout.fnmatch_lines(["*test_new PASSED*", "*1 passed, 2 deselected*"])
+
+    def test_doctest_modules(self, testdir):
+        testdir.mkpydir('pkg').join('foo.py').write('def f():\n    """\n    >>> f()\n    1\n    """\n    return 1\n')
+        testdir.tmpdir.join('pkg', 'test_foo.py').write("def test_foo():\n    pass\n")
+        testdir.runpytest("--testmon", "--doctest-modules")
+
+        result = testdir.runpytest("--testmon", "--doctest-modules", "-v")
+        result.stdout.fnmatch_lines(["*2 deselected*"])
+
+        testdir.tmpdir.join('pkg', 'foo.py').write('def f():\n    """\n    >>> f()\n    1\n    """\n    return 2\n')
+        result = testdir.runpytest("--testmon", "--doctest-modules", "-v")
+        result.stdout.fnmatch_lines(["*pkg.foo.f FAILED*", "*1 failed, 1 deselected*"])
+        result = testdir.runpytest("--testmon", "--doctest-modules", "-v")
+        result.stdout.fnmatch_lines(["*pkg.foo.f FAILED*"])
+
+    def test_unaffected_directory_not_collected(self, testdir):
+        testdir.makepyfile(test_a="def test_a():\n    pass\n")
+        pkg = testdir.mkpydir('pkg')
+        pkg.join('test_b.py').write("def test_b():\n    pass\n")
+        pkg.mkdir('sub').join('test_c.py').write("def test_c():\n    pass\n")
+        testdir.runpytest("--testmon").assert_outcomes(passed=3)
+
+        pkg.join('conftest.py').write("raise Exception('pkg was collected')\n")
+        testdir.tmpdir.join('test_a.py').write("def test_a():\n    assert True\n")
+        result = testdir.runpytest("--testmon")
+        result.stdout.fnmatch_lines(["*1 passed, 2 deselected*"])
+
+        pkg.join('conftest.py').remove()
+        pkg.join('test_d.py').write("def test_d():\n    pass\n")
+        result = testdir.runpytest("--testmon", "-v")
+        result.stdout.fnmatch_lines(["*test_d PASSED*", "*1 passed, 3 deselected*"])
+
     def test_dont_readcoveragerc(self, testdir, monkeypatch):
         monkeypatch.setenv("PYTHONDONTWRITEBYTECODE", 1)
         p = testdir.tmpdir.join('.coveragerc')
@@ -0,0 +1,228 @@
+"""
+Long running process which watches the project directory (with inotify, Linux only) and
+keeps parsed versions of the files written since it started. pytest --testmon --testmon-daemon
+asks it which files changed since the previous run instead of checking mtimes of all files.
+
+    python -m testmon.daemon [rootdir]
+"""
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import uuid
+
+from testmon.testmon_core import read_file_with_checksum, parse_file
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+# sun_path of AF_UNIX sockets has 108 bytes on Linux
+MAX_SOCKET_PATH = 100
+
+
+def socket_path(rootdir):
+    """.testmondaemon next to .testmondata, only users who can write to the project can replace it.
+    A path too long for AF_UNIX goes to the private directory of the user instead."""
+    path = os.path.join(os.path.abspath(rootdir), '.testmondaemon')
+    if len(path.encode(sys.getfilesystemencoding())) <= MAX_SOCKET_PATH:
+        return path
+    return os.path.join(private_directory(),
+                        'testmon-{}.sock'.format(hashlib.md5(os.path.abspath(rootdir).encode()).hexdigest()[:16]))
+
+
+def private_directory():
+    """testmon-<uid> in the temp directory, readable and writable only by the user."""
+    directory = os.path.join(tempfile.gettempdir(), 'testmon-{}'.format(os.getuid()))
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise OSError(errno.EPERM, "{} is not a private directory of the user".format(directory))
+    return directory
+
+
+def ignored_directory(dirname):
+    return dirname.startswith('.') or dirname == '__pycache__'
+
+
+class Inotify(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), WATCH_MASK)
+        if wd >= 0:
+            self.directories[wd] = directory
+
+    def add_tree(self, directory):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [dirname for dirname in dirnames if not ignored_directory(dirname)]
+            self.add_watch(dirpath)
+
+    def read_events(self):
+        """Yields (mask, path) of all pending events, path is None for IN_Q_OVERFLOW."""
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+                offset += length
+                if mask & IN_IGNORED:
+                    self.directories.pop(wd, None)
+                elif mask & IN_Q_OVERFLOW:
+                    yield mask, None
+                elif wd in self.directories:
+                    yield mask, os.path.join(self.directories[wd], name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Daemon(object):
+    """Every observed change of a .py file increments generation. changes maps
+    the changed file (relative to rootdir) to (generation, file info or None when deleted)."""
+
+    def __init__(self, rootdir):
+        self.rootdir = os.path.abspath(rootdir)
+        self.id = uuid.uuid4().hex
+        self.generation = 0
+        self.changes = {}
+        self.inotify = Inotify()
+        self.inotify.add_tree(self.rootdir)
+        self.socket_path = socket_path(self.rootdir)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(5)
+
+    def file_info(self, filename):
+        absfilename = os.path.join(self.rootdir, filename)
+        try:
+            mtime = os.path.getmtime(absfilename)
+            code, checksum = read_file_with_checksum(absfilename)
+        except (OSError, IOError):
+            return None
+        return {'mtime': mtime,
+                'checksum': checksum,
+                'blocks': parse_file(filename=filename, rootdir=self.rootdir, source_code=code).block_tuples}
+
+    def process_events(self):
+        for mask, path in self.inotify.read_events():
+            if path is None:
+                # events were lost, clients can't rely on anything we recorded so far
+                self.id = uuid.uuid4().hex
+                self.changes = {}
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not ignored_directory(os.path.basename(path)):
+                    self.inotify.add_tree(path)
+            elif path.endswith('.py') and mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+                self.generation += 1
+                filename = os.path.relpath(path, self.rootdir)
+                self.changes[filename] = (self.generation, self.file_info(filename))
+
+    def answer(self, request):
+        """Changes newer than request['generation'] if the request is for this daemon instance,
+        otherwise files is None and the client has to check all files itself."""
+        self.process_events()
+        response = {'daemon': self.id, 'generation': self.generation, 'files': None}
+        if request.get('daemon') == self.id:
+            response['files'] = dict((filename, info)
+                                     for filename, (generation, info) in self.changes.items()
+                                     if generation > request.get('generation', 0) and info is not None)
+        return response
+
+    def handle_client(self):
+        connection, address = self.server.accept()
+        try:
+            connection.settimeout(5)
+            request = json.loads(connection.makefile('r').readline())
+            connection.sendall((json.dumps(self.answer(request)) + '\n').encode('utf-8'))
+        except (socket.error, ValueError):
+            pass
+        finally:
+            connection.close()
+
+    def serve_forever(self):
+        while True:
+            readable, _, _ = select.select([self.inotify, self.server], [], [])
+            if self.inotify in readable:
+                self.process_events()
+            if self.server in readable:
+                self.handle_client()
+
+    def close(self):
+        self.server.close()
+        self.inotify.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def query(rootdir, daemon_id, generation, timeout=2):
+    """Ask the daemon watching rootdir for changes, returns None when no daemon is running."""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(socket_path(rootdir))
+        client.sendall((json.dumps({'daemon': daemon_id, 'generation': generation}) + '\n').encode('utf-8'))
+        return json.loads(client.makefile('r').readline())
+    except (OSError, socket.error, ValueError):
+        return None
+    finally:
+        client.close()
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    if not sys.platform.startswith('linux'):
+        sys.exit("testmon daemon requires inotify (Linux)")
+    daemon = Daemon(args[0] if args else os.getcwd())
+    print("testmon daemon watching {} on {}".format(daemon.rootdir, daemon.socket_path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == '__main__':
+    main()
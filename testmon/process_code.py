@@ -3,21 +3,24 @@ import textwrap
 import zlib
 import os
 
+# Changes whenever Module computes different checksums for the same source code.
+# 1: adler32 of the whole ast.dump like representation, 2: streamed crc32
+CHECKSUM_VERSION = 2
+
+
+class Block(object):
+    __slots__ = ('start', 'end', 'name', 'code', 'checksum')
 
-class Block():
     def __init__(self, start, end, code=0, name=''):
         # assert start <= end
         self.start = start
         self.end = end
         self.name = name
         self.code = code
-
-    @property
-    def checksum(self):
-        if isinstance(self.code, int):
-            return self.code
+        if isinstance(code, int):
+            self.checksum = code
         else:
-            return zlib.adler32(self.code.encode('UTF-8'))
+            self.checksum = zlib.adler32(code.encode('UTF-8')) & 0xffffffff
 
     def __repr__(self):
         return "{}-{} h: {}, n:{}, repr:{}".format(self.start,
@@ -39,10 +42,37 @@ class Block():
         return not self.__eq__(other)
 
 
+class BlockTable(object):
+    """Start lines, end lines and checksums of blocks in parallel tuples, sorted by start line."""
+    __slots__ = ('starts', 'ends', 'checksums')
+
+    def __init__(self, blocks):
+        blocks = sorted(blocks, key=lambda block: block.start)
+        self.starts = tuple(block.start for block in blocks)
+        self.ends = tuple(block.end for block in blocks)
+        self.checksums = tuple(block.checksum for block in blocks)
+
+    def covered(self, lines):
+        """Checksums of the blocks containing at least one of lines."""
+        sorted_lines = sorted(lines)
+        line_count = len(sorted_lines)
+        line_index = 0
+        result = []
+        for start, end, checksum in zip(self.starts, self.ends, self.checksums):
+            while line_index < line_count and sorted_lines[line_index] < start:
+                line_index += 1
+            if line_index == line_count:
+                break
+            if sorted_lines[line_index] <= end:
+                result.append(checksum)
+        return result
+
+
 class Module(object):
     def __init__(self, source_code=None, file_name='<unknown>', rootdir=''):
         self.blocks = []
         self.counter = 0
+        self._table = None
         if source_code is None:
             with open(os.path.join(rootdir, file_name)) as f:
                 source_code = f.read()
@@ -51,56 +81,74 @@ class Module(object):
         lines = source_code.splitlines()
         try:
             tree = ast.parse(source_code, file_name)
-            self.dump_and_block(tree, len(lines), name=file_name)
+            self.checksum_and_block(tree, len(lines), name=file_name)
         except SyntaxError:
             pass
 
-    def dump_and_block(self, node, end, name='unknown', into_block=False):
+    @classmethod
+    def from_blocks(cls, blocks):
+        """Module from already computed [(start, end, name, checksum), ...] without parsing the source."""
+        module = cls.__new__(cls)
+        module.blocks = [Block(start, end, code=checksum, name=name) for start, end, name, checksum in blocks]
+        module.counter = len(module.blocks)
+        module._table = None
+        return module
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = BlockTable(self.blocks)
+        return self._table
+
+    @property
+    def block_tuples(self):
+        return [(block.start, block.end, block.name, block.checksum) for block in self.blocks]
+
+    def checksum_and_block(self, node, end, checksum=0, name='unknown', into_block=False):
         """Frame of this method is taken from ast.dump
-        Objective is to return a representation of python source code where
+        Objective is to checksum a representation of python source code where
         all of the bodies of functions are replaced with 'transformed_into_block'
-        string. The rest of the syntax tree is represented in the same way as
-        in ast.dump(tree, annotate_fields=False). Of course the bodies of functions
-        are not completely thrown away, they are transformed into Block() objects
-        and appended to self.blocks. More can be probably understood from
-        (at the time rather messy) test_process_code.py examples.
+        string. The node types and field values are fed one by one into an incremental
+        crc32 (no representation of the tree is ever built), the return value is the
+        updated checksum. The bodies of functions are not completely thrown away, they
+        get their own checksum and are appended to self.blocks as Block() objects.
+        More can be probably understood from (at the time rather messy)
+        test_process_code.py examples.
         """
 
-        def _next_lineno(i, end):
-            try:
-                return node[i + 1].lineno - 1
-            except IndexError:
-                return end
-            except AttributeError:
-                return None
-
         if isinstance(node, ast.AST):
             class_name = node.__class__.__name__
-            fields = []
+            checksum = zlib.crc32(class_name.encode('UTF-8'), checksum)
             for field_name, field_value in ast.iter_fields(node):
                 transform_into_block = ((class_name in ('FunctionDef', 'Module'))
                                         and field_name == 'body')
-                fields.append((field_name,
-                               self.dump_and_block(field_value,
+                checksum = self.checksum_and_block(field_value,
                                                    end,
+                                                   checksum,
                                                    name=getattr(node, 'name', 'unknown'),
-                                                   into_block=transform_into_block)))
-            return '%s(%s)' % (class_name,
-                               ', '.join((field_value for field_name, field_value in fields))
-                               )
+                                                   into_block=transform_into_block)
+            return zlib.crc32(b')', checksum)
         elif isinstance(node, list):
-            representations = []
+            block = bool(into_block and node)
+            items_checksum = 0 if block else zlib.crc32(b'[', checksum)
             for i, item in enumerate(node):
-                representations.append(self.dump_and_block(item, _next_lineno(i, end)))
-            if into_block and node:
+                try:
+                    item_end = node[i + 1].lineno - 1
+                except IndexError:
+                    item_end = end
+                except AttributeError:
+                    item_end = None
+                items_checksum = self.checksum_and_block(item, item_end, items_checksum)
+            if block:
+                items_checksum = zlib.crc32(':{}'.format(self.counter).encode('UTF-8'), items_checksum)
                 self.blocks.append(Block(node[0].lineno,
                                          end,
-                                         code=str(self.counter) + ":" + ", ".join(representations), name=name))
+                                         code=items_checksum & 0xffffffff, name=name))
                 self.counter += 1
-                return 'transformed_into_block'
+                return zlib.crc32(b'transformed_into_block', checksum)
             else:
-                return ", ".join(representations)
-        return repr(node)
+                return zlib.crc32(b']', items_checksum)
+        return zlib.crc32(repr(node).encode('UTF-8'), checksum)
 
     @property
     def checksums(self):
@@ -108,17 +156,7 @@ class Module(object):
 
 
 def checksum_coverage(blocks, lines):
-    result = []
-    line_index = 0
-    sorted_lines = sorted(list(lines))
-
-    for current_block in sorted(blocks, key=lambda x: x.start):
-        try:
-            while sorted_lines[line_index] < current_block.start:
-                line_index += 1
-            if sorted_lines[line_index] <= current_block.end:
-                result.append(current_block.checksum)
-        except IndexError:
-            break
-
-    return result
+    """blocks is a list of Block or a BlockTable (Module.table, built once per module)."""
+    if not isinstance(blocks, BlockTable):
+        blocks = BlockTable(blocks)
+    return blocks.covered(lines)
@@ -2,10 +2,18 @@
 Main module of testmon pytest plugin.
 """
 from __future__ import division
+import argparse
+import fnmatch
 import os
+import subprocess
+import sys
+from collections import defaultdict
+
+import py
 import pytest
 
 from testmon.testmon_core import Testmon, eval_variant, TestmonData
+from testmon.scheduling import longest_first, partition, riskiest_first
 from _pytest import runner
 
 
@@ -17,7 +25,6 @@ def unserialize_report(name, reportdict):
 
 
 def serialize_report(rep):
-    import py
     d = rep.__dict__.copy()
     if hasattr(rep.longrepr, 'toterminal'):
         d['longrepr'] = str(rep.longrepr)
@@ -31,6 +38,17 @@ def serialize_report(rep):
     return d
 
 
+def shard(value):
+    """'i/n' -> (i, n), shards are numbered from 1."""
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/n, got {!r}".format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard {} of {} doesn't exist".format(index, count))
+    return index, count
+
+
 def pytest_addoption(parser):
     group = parser.getgroup('testmon')
 
@@ -69,6 +87,86 @@ def pytest_addoption(parser):
         help="Don't track, just deselect based on existing .testmondata"
     )
 
+    group.addoption(
+        '--testmon-lazy',
+        action='store_true',
+        dest='testmon_lazy',
+        help="Load dependencies of a test from .testmondata only when needed instead of all at startup"
+    )
+
+    group.addoption(
+        '--testmon-workers',
+        action='store',
+        type=int,
+        dest='testmon_workers',
+        default=1,
+        help="Number of threads/processes used to detect changed files (0 means number of CPUs)"
+    )
+
+    group.addoption(
+        '--testmon-git',
+        action='store_true',
+        dest='testmon_git',
+        help="Ask git which files can have changed since the last run instead of checking mtimes of all files"
+    )
+
+    group.addoption(
+        '--testmon-daemon',
+        action='store_true',
+        dest='testmon_daemon',
+        help="Get changed files from a running 'python -m testmon.daemon' (checks files as usual when it's not running)"
+    )
+
+    group.addoption(
+        '--testmon-tracer',
+        action='store',
+        dest='testmon_tracer',
+        choices=['coverage', 'lines', 'functions'],
+        default='coverage',
+        help="How executed code is measured: 'coverage' (coverage.py, default), 'lines' "
+             "(testmon's own low overhead line tracer using sys.monitoring or sys.settrace) or "
+             "'functions' (only records which functions were called, lowest overhead)"
+    )
+
+    group.addoption(
+        '--testmon-order',
+        action='store',
+        dest='testmon_order',
+        choices=['collection', 'duration', 'risk'],
+        default='collection',
+        help="Order of the selected tests: 'collection' (default), 'duration' (longest first by the "
+             "durations recorded in .testmondata, with xdist --dist loadgroup the tests are also "
+             "partitioned into one group per worker with equal total duration) or 'risk' (tests which "
+             "failed last time, new tests and tests depending on most changed blocks first)"
+    )
+
+    group.addoption(
+        '--testmon-shard',
+        action='store',
+        type=shard,
+        dest='testmon_shard',
+        default=None,
+        help="i/n: run only the i-th of n parts of the selected tests. The parts have equal total "
+             "duration (by .testmondata) and are the same on every machine with the same .testmondata"
+    )
+
+    group.addoption(
+        '--testmon-remote',
+        action='store',
+        dest='testmon_remote',
+        default=None,
+        help="Directory or http(s) URL of a shared snapshot store (see testmon.snapshot). Without "
+             "any data for the run variant, .testmondata starts from the snapshot of the nearest "
+             "ancestor commit found there"
+    )
+
+    group.addoption(
+        '--testmon-remote-push',
+        action='store_true',
+        dest='testmon_remote_push',
+        help="Store a snapshot of .testmondata for HEAD in --testmon-remote at the end of the session"
+    )
+
     group.addoption(
         '--project-directory',
         action='append',
@@ -80,6 +178,15 @@ def pytest_addoption(parser):
     parser.addini("run_variant_expression", "run variant expression",
                   default='')
 
+    parser.addini("testmon_flush_interval", "seconds between writes of collected dependencies to .testmondata",
+                  default='5')
+
+    parser.addini("testmon_remote", "directory or http(s) URL of a shared snapshot store (--testmon-remote)",
+                  default='')
+
+    parser.addini("testmon_sqlite_synchronous", "value of PRAGMA synchronous for .testmondata (OFF, NORMAL, FULL)",
+                  default='NORMAL')
+
 
 def testmon_options(config):
     result = []
@@ -90,15 +197,69 @@ def testmon_options(config):
     return result
 
 
+def xdist_workerinput(config_or_node):
+    """workerinput (slaveinput in xdist < 1.22) of an xdist worker, None outside of xdist workers."""
+    return getattr(config_or_node, 'workerinput', getattr(config_or_node, 'slaveinput', None))
+
+
+def xdist_workeroutput(config_or_node):
+    return getattr(config_or_node, 'workeroutput', getattr(config_or_node, 'slaveoutput', None))
+
+
+def is_xdist_controller(config):
+    return (xdist_workerinput(config) is None and
+            config.getoption('dist', 'no') != 'no' and not config.getoption('collectonly'))
+
+
+def remote_store(config):
+    location = config.getoption('testmon_remote') or config.getini('testmon_remote')
+    if location:
+        from testmon.snapshot import open_store
+        return open_store(location)
+
+
+def pull_snapshot(config, testmon_data):
+    """A fresh checkout starts from the data the shared store has for the nearest ancestor commit."""
+    store = remote_store(config)
+    if store is not None and not testmon_data.has_data():
+        from testmon.snapshot import restore
+        try:
+            restore(testmon_data, store)
+        except (OSError, IOError, ValueError, subprocess.CalledProcessError) as e:
+            # a broken or corrupt snapshot leaves the data empty, the session starts cold
+            sys.stderr.write("testmon: can't restore a snapshot from the remote store: {}\n".format(e))
+
+
+def push_snapshot(config, testmon_data):
+    store = remote_store(config)
+    if store is not None and config.getoption('testmon_remote_push'):
+        from testmon.snapshot import export
+        try:
+            export(testmon_data, store)
+        except (OSError, IOError, subprocess.CalledProcessError) as e:
+            sys.stderr.write("testmon: can't push a snapshot to the remote store: {}\n".format(e))
+
+
 def init_testmon_data(config, read_source=True):
     if not hasattr(config, 'testmon_data'):
         variant = eval_variant(config.getini('run_variant_expression'))
         config.project_dirs = config.getoption('project_directory') or [config.rootdir.strpath]
+        workerinput = xdist_workerinput(config)
+        # xdist workers hand the dependencies over to the controller, which writes them all
         testmon_data = TestmonData(config.project_dirs[0],
-                                   variant=variant)
-        testmon_data.read_data()
-        if read_source:
-            testmon_data.read_source()
+                                   variant=variant,
+                                   flush_interval=(float('inf') if workerinput is not None
+                                                   else float(config.getini('testmon_flush_interval'))),
+                                   synchronous=config.getini('testmon_sqlite_synchronous'))
+        if read_source and workerinput is None:
+            pull_snapshot(config, testmon_data)
+        testmon_data.read_data(lazy=(read_source and config.getoption('testmon_lazy')) or workerinput is not None)
+        if read_source and workerinput is not None:
+            testmon_data.load_xdist_state(workerinput['testmon'])
+        elif read_source:
+            testmon_data.read_source(workers=config.getoption('testmon_workers'),
+                                     use_git=config.getoption('testmon_git'),
+                                     use_daemon=config.getoption('testmon_daemon'))
         config.testmon_data = testmon_data
 
 
@@ -118,47 +279,86 @@ def is_active(config):
 
 def pytest_configure(config):
     if is_active(config):
-        config.pluginmanager.register(TestmonDeselect(config, config.testmon_data),
-                                      "TestmonDeselect")
+        if is_xdist_controller(config):
+            config.pluginmanager.register(TestmonXdistController(config, config.testmon_data),
+                                          "TestmonXdistController")
+        else:
+            config.pluginmanager.register(TestmonDeselect(config, config.testmon_data),
+                                          "TestmonDeselect")
 
 
 def by_test_count(config, session):
-    file_data = config.testmon_data.file_data()
-    for filename, nodeids in sorted(file_data.items(), key=lambda ite: len(ite[1]), reverse=True):
+    file_nodeids = config.testmon_data.file_nodeids()
+    for filename, nodeids in sorted(file_nodeids.items(), key=lambda ite: len(ite[1]), reverse=True):
         print("%s: %s" % (len(nodeids), os.path.relpath(filename)))
 
 
+def is_collected(config, path):
+    """Can pytest collect tests from the file (python_files, --doctest-modules and --doctest-glob)?"""
+    path = py.path.local(path)
+    if path.ext == '.py':
+        return (config.getoption('doctestmodules', False) or
+                any(path.fnmatch(pattern) for pattern in config.getini('python_files')))
+    return any(path.fnmatch(pattern) for pattern in config.getoption('doctestglob', None) or ['test*.txt'])
+
+
+def parent_directories(directory):
+    """directory and its parents up to (not including) the rootdir."""
+    while directory not in ('', os.curdir):
+        yield directory
+        directory = os.path.dirname(directory)
+
+
+def header_message(config, testmon_data):
+    changed_files = ",".join(testmon_data.source_tree.changed_files)
+    if changed_files == '' or len(changed_files) > 100:
+        changed_files = len(testmon_data.source_tree.changed_files)
+    active_message = "testmon={}, changed files: {}, skipping collection of {} items".format(
+        config.getoption('testmon'),
+        changed_files, len(testmon_data.unaffected_nodeids))
+    if testmon_data.variant:
+        return active_message + ", run variant: {}".format(testmon_data.variant)
+    else:
+        return active_message + "."
+
+
+def report_if_failed(config, testmon_data, nodeid):
+    if nodeid in testmon_data.fail_reports:
+        for report in testmon_data.fail_reports[nodeid]:
+            test_report = unserialize_report('testreport', report)
+            config.hook.pytest_runtest_logreport(report=test_report)
+
+
 class TestmonDeselect(object):
     def __init__(self, config, testmon_data):
         self.testmon_data = testmon_data
-        self.testmon = Testmon(config.project_dirs, testmon_labels=testmon_options(config))
+        self.testmon = Testmon(config.project_dirs, testmon_labels=testmon_options(config),
+                               tracer=config.getoption('testmon_tracer'))
         self.collection_ignored = set()
         self.testmon_save = True
         self.config = config
+        self.workeroutput = xdist_workeroutput(config)
+        self._unaffected_directories = None
 
     def pytest_report_header(self, config):
-        changed_files = ",".join(self.testmon_data.source_tree.changed_files)
-        if changed_files == '' or len(changed_files) > 100:
-            changed_files = len(self.testmon_data.source_tree.changed_files)
-        active_message = "testmon={}, changed files: {}, skipping collection of {} items".format(
-            config.getoption('testmon'),
-            changed_files, len(self.testmon_data.unaffected_nodeids))
-        if self.testmon_data.variant:
-            return active_message + ", run variant: {}".format(self.testmon_data.variant)
-        else:
-            return active_message + "."
+        return header_message(config, self.testmon_data)
 
     def report_if_failed(self, nodeid):
-        if nodeid in self.testmon_data.fail_reports:
-            for report in self.testmon_data.fail_reports[nodeid]:
-                test_report = unserialize_report('testreport', report)
-                self.config.hook.pytest_runtest_logreport(report=test_report)
+        shard = self.config.getoption('testmon_shard')
+        # the xdist controller reports them, with sharding only the first shard does
+        if self.workeroutput is None and (shard is None or shard[0] == 1):
+            report_if_failed(self.config, self.testmon_data, nodeid)
 
+    @pytest.hookimpl(tryfirst=True)
     def pytest_collection_modifyitems(self, session, config, items):
-        removed_nodeids = set(self.testmon_data.node_data) - self.collection_ignored - set(
-            [item.nodeid for item in items])
-        if removed_nodeids:
-            self.testmon_data.collect_garbage(removed_nodeids)
+        if self.workeroutput is not None:
+            self.workeroutput['testmon_collected'] = sorted(self.collection_ignored |
+                                                            set(item.nodeid for item in items))
+        else:
+            removed_nodeids = set(self.testmon_data.node_data) - self.collection_ignored - set(
+                [item.nodeid for item in items])
+            if removed_nodeids:
+                self.testmon_data.collect_garbage(removed_nodeids)
 
         selected, deselected = [], []
         for item in items:
@@ -170,19 +370,50 @@ class TestmonDeselect(object):
                 deselected.append(item)
         for nodeid in self.collection_ignored:
             self.report_if_failed(nodeid)
+        if config.getoption('testmon_shard'):
+            selected, other_shards = self.select_shard(selected, *config.getoption('testmon_shard'))
+            deselected.extend(other_shards)
         items[:] = selected
+        if config.getoption('testmon_order') == 'duration':
+            self.order_by_duration(items)
+        elif config.getoption('testmon_order') == 'risk':
+            self.order_by_risk(items)
         if deselected:
             config.hook.pytest_deselected(items=deselected)
 
+    def select_shard(self, items, index, count):
+        """(items of shard index, items of the other shards)"""
+        shards = partition([item.nodeid for item in items], self.testmon_data.get_durations(), count)
+        in_shard = set(shards[index - 1])
+        return ([item for item in items if item.nodeid in in_shard],
+                [item for item in items if item.nodeid not in in_shard])
+
+    def order_by_duration(self, items):
+        by_nodeid = dict((item.nodeid, item) for item in items)
+        items[:] = [by_nodeid[nodeid] for nodeid in longest_first([item.nodeid for item in items],
+                                                                  self.testmon_data.get_durations())]
+
+    def order_by_risk(self, items):
+        by_nodeid = dict((item.nodeid, item) for item in items)
+        items[:] = [by_nodeid[nodeid] for nodeid in riskiest_first([item.nodeid for item in items],
+                                                                   self.testmon_data.fail_reports,
+                                                                   self.testmon_data.node_data,
+                                                                   self.testmon_data.changed_blocks)]
+
     @pytest.mark.hookwrapper
     def pytest_runtest_protocol(self, item, nextitem):
         if self.config.getoption('testmon') == u'readonly':
             yield
 
         self.testmon.start()
-        yield
-        self.testmon.stop_and_save(self.testmon_data, item.config.rootdir.strpath, item.nodeid,
-                                   self.testmon_data.reports[item.nodeid])
+        outcome = yield
+        if outcome.excinfo is None:
+            self.testmon.stop_and_save(self.testmon_data, item.config.rootdir.strpath, item.nodeid,
+                                       self.testmon_data.reports[item.nodeid])
+        else:
+            # interrupted (KeyboardInterrupt, pytest.exit, ...): the dependencies and the outcome
+            # are incomplete, the test has to run again next time
+            self.testmon.stop()
         del self.testmon_data.reports[item.nodeid]
 
     def pytest_runtest_logreport(self, report):
@@ -192,16 +423,52 @@ class TestmonDeselect(object):
         def __init__(self, config):
             self.config = config
 
+    def ignore_module(self, config, strpath):
+        # pytest can ask about the files of a package twice (Session and Package collectors)
+        nodeids = [nodeid for nodeid in self.testmon_data.module_nodeids().get(strpath.replace(os.sep, '/'), [])
+                   if nodeid not in self.collection_ignored]
+        self.collection_ignored.update(nodeids)
+        config.hook.pytest_deselected(items=[self.FakeItemFromTestmon(config)] * len(nodeids))
+
+    def unaffected_directories(self, config):
+        """{directory: the test files in it} of the directories in which every file pytest would
+        collect is in unaffected_files, from one walk of the rootdir. A new or affected test file
+        in a directory or any of its subdirectories keeps it (and its parents) out."""
+        if self._unaffected_directories is None:
+            rootdir = config.rootdir.strpath
+            norecursedirs = config.getini('norecursedirs') + ['__pycache__']
+            unaffected = defaultdict(list)
+            affected = set()
+            for dirpath, dirnames, filenames in os.walk(rootdir):
+                dirnames[:] = [dirname for dirname in dirnames
+                               if not any(fnmatch.fnmatch(dirname, pattern) for pattern in norecursedirs)]
+                directories = list(parent_directories(os.path.relpath(dirpath, rootdir)))
+                for filename in filenames:
+                    if not is_collected(config, os.path.join(dirpath, filename)):
+                        continue
+                    strpath = os.path.normpath(os.path.join(os.path.relpath(dirpath, rootdir), filename))
+                    if strpath in self.testmon_data.unaffected_files:
+                        for directory in directories:
+                            unaffected[directory].append(strpath)
+                    else:
+                        affected.update(directories)
+            self._unaffected_directories = dict((directory, strpaths) for directory, strpaths in unaffected.items()
+                                                if directory not in affected)
+        return self._unaffected_directories
+
     def pytest_ignore_collect(self, path, config):
         strpath = os.path.relpath(path.strpath, config.rootdir.strpath)
         if strpath in self.testmon_data.unaffected_files:
-            if os.path.split(strpath)[1].startswith('test_'):
-                for nodeid in self.testmon_data.file_data()[strpath]:
-                    self.collection_ignored.add(nodeid)
-                config.hook.pytest_deselected(
-                    items=([self.FakeItemFromTestmon(config)] *
-                           len(self.testmon_data.file_data()[strpath])))
+            # the known tests of any ignored file (e.g. doctests of a module) are kept in .testmondata
+            self.ignore_module(config, strpath)
             return True
+        if self.testmon_data.unaffected_files and path.check(dir=1):
+            # pytest doesn't descend into (or import the conftest.py of) a directory without affected tests
+            strpaths = self.unaffected_directories(config).get(strpath)
+            if strpaths:
+                for module in strpaths:
+                    self.ignore_module(config, module)
+                return True
 
     def pytest_internalerror(self, excrepr, excinfo):
         self.testmon_save = False
@@ -210,6 +477,103 @@ class TestmonDeselect(object):
         self.testmon_save = False
 
     def pytest_sessionfinish(self, session):
+        if self.workeroutput is not None:
+            source_tree = self.testmon_data.source_tree
+            self.workeroutput['testmon_dependencies'] = [list(dependency) for dependency
+                                                         in self.testmon_data.pending_dependencies]
+            self.workeroutput['testmon_files'] = dict((filename, [mtime, source_tree.checksums[filename]])
+                                                      for filename, mtime in source_tree.mtimes.items())
+            self.testmon_data.pending_dependencies = []
+        else:
+            # dependencies of the tests which finished are valid even after an interruption
+            self.testmon_data.flush()
+            if self.testmon_save:
+                self.testmon_data.write_data()
+                push_snapshot(self.config, self.testmon_data)
+        self.testmon.close()
+
+
+def duration_group_scheduling(config, log, durations):
+    """xdist --dist loadgroup scheduler which splits the tests without an xdist_group marker into
+    one group per worker with equal total duration. The groups exist only here in the controller,
+    the nodeids (and so the nodeids in .testmondata) stay as they are."""
+    from xdist.scheduler import LoadGroupScheduling
+
+    def has_group(nodeid):
+        return nodeid.rfind('@') > nodeid.rfind(']')
+
+    class DurationGroupScheduling(LoadGroupScheduling):
+        groups = None
+
+        def _split_scope(self, nodeid):
+            if has_group(nodeid):
+                return LoadGroupScheduling._split_scope(self, nodeid)
+            if self.groups is None:
+                self.groups = {}
+                ungrouped = [other for other in self.collection if not has_group(other)]
+                for index, group in enumerate(partition(ungrouped, durations, self.numnodes)):
+                    for other in group:
+                        self.groups[other] = 'testmon{}'.format(index)
+            return self.groups[nodeid]
+
+    return DurationGroupScheduling(config, log)
+
+
+class TestmonXdistController(object):
+    """Replaces TestmonDeselect in the xdist controller. The changes are checked only here,
+    the workers get the result in workerinput, run and trace the tests and return the
+    dependencies in workeroutput. The controller is the only process writing .testmondata."""
+
+    def __init__(self, config, testmon_data):
+        self.config = config
+        self.testmon_data = testmon_data
+        self.collected = None
+        self.testmon_save = True
+        if config.getoption('testmon_order') == 'duration' or config.getoption('testmon_shard'):
+            # sent to the workers with the rest of xdist_state()
+            testmon_data.get_durations()
+
+    def pytest_report_header(self, config):
+        return header_message(config, self.testmon_data)
+
+    @pytest.hookimpl(optionalhook=True, tryfirst=True)
+    def pytest_xdist_make_scheduler(self, config, log):
+        if config.getoption('testmon_order') == 'duration' and config.getoption('dist') == 'loadgroup':
+            return duration_group_scheduling(config, log, self.testmon_data.get_durations())
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_configure_node(self, node):
+        xdist_workerinput(node)['testmon'] = self.testmon_data.xdist_state()
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodedown(self, node, error):
+        workeroutput = xdist_workeroutput(node) or {}
+        source_tree = self.testmon_data.source_tree
+        for filename, (mtime, checksum) in workeroutput.get('testmon_files', {}).items():
+            if filename not in source_tree.mtimes:
+                source_tree.mtimes[filename] = mtime
+                source_tree.checksums[filename] = checksum
+        for nodeid, nodedata, result in workeroutput.get('testmon_dependencies', []):
+            self.testmon_data.set_dependencies(nodeid, nodedata, result)
+        if self.collected is None and 'testmon_collected' in workeroutput:
+            # all workers collect the same tests
+            self.collected = set(workeroutput['testmon_collected'])
+            removed_nodeids = set(self.testmon_data.node_data) - self.collected
+            if removed_nodeids:
+                self.testmon_data.collect_garbage(removed_nodeids)
+            shard = self.config.getoption('testmon_shard')
+            for nodeid in sorted(self.testmon_data.unaffected_nodeids & self.collected):
+                if shard is None or shard[0] == 1:
+                    report_if_failed(self.config, self.testmon_data, nodeid)
+
+    def pytest_internalerror(self, excrepr, excinfo):
+        self.testmon_save = False
+
+    def pytest_keyboard_interrupt(self, excinfo):
+        self.testmon_save = False
+
+    def pytest_sessionfinish(self, session):
+        self.testmon_data.flush()
         if self.testmon_save:
             self.testmon_data.write_data()
-        self.testmon.close()
+            push_snapshot(self.config, self.testmon_data)
@@ -0,0 +1,41 @@
+"""
+Ordering and partitioning of the selected tests by what .testmondata knows about them
+(--testmon-order).
+"""
+import heapq
+
+
+def estimates(nodeids, durations):
+    """Recorded duration of every test, tests which never finished are expected
+    to take the average of the known ones."""
+    known = [durations[nodeid] for nodeid in nodeids if nodeid in durations]
+    default = sum(known) / len(known) if known else 0.0
+    return dict((nodeid, durations.get(nodeid, default)) for nodeid in nodeids)
+
+
+def longest_first(nodeids, durations):
+    """Stable: tests with the same duration keep their collection order."""
+    estimate = estimates(nodeids, durations)
+    return sorted(nodeids, key=lambda nodeid: -estimate[nodeid])
+
+
+def partition(nodeids, durations, bins):
+    """Longest processing time first bin packing: the tests, longest first, go one by one
+    to the bin with the smallest total duration so far. Returns `bins` lists of nodeids."""
+    estimate = estimates(nodeids, durations)
+    result = [[] for _ in range(bins)]
+    # bins with the same total (e.g. no durations recorded yet) are filled by the number of tests
+    totals = [(0.0, 0, index) for index in range(bins)]
+    for nodeid in longest_first(nodeids, durations):
+        total, count, index = heapq.heappop(totals)
+        result[index].append(nodeid)
+        heapq.heappush(totals, (total + estimate[nodeid], count + 1, index))
+    return result
+
+
+def riskiest_first(nodeids, failed, known, changed_blocks):
+    """Tests which failed in their last run first, then new tests (not in known),
+    then the tests depending on the most changed blocks. Stable like longest_first."""
+    return sorted(nodeids, key=lambda nodeid: (nodeid not in failed,
+                                               nodeid in known,
+                                               -changed_blocks.get(nodeid, 0)))
@@ -0,0 +1,246 @@
+"""
+Snapshots of .testmondata for CI caches and shared stores. A snapshot is the compressed JSON
+of one variant (TestmonData.dump()) stored under its sha256, refs map commit and variant to it:
+
+    STORE/objects/<sha256>.json.zlib
+    STORE/refs/<variant hash>/<commit>
+
+STORE is a directory (DirectoryStore) or a http(s) URL (HTTPStore), anything with get(key)
+and put(key, data) can be used as a store.
+
+    python -m testmon.snapshot export STORE [--commit C]        # after the mainline build
+    python -m testmon.snapshot import STORE [--commit C]        # before a PR build
+    python -m testmon.snapshot merge STORE --commit C --base BASE SNAPSHOT...   # after sharded jobs
+
+import without --commit restores the snapshot of the nearest ancestor of HEAD which has one.
+"""
+import argparse
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import zlib
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+    from http.client import HTTPException
+except ImportError:  # python 2
+    from urllib2 import Request, urlopen, HTTPError
+    from httplib import HTTPException
+
+from testmon.testmon_core import TestmonData, git
+
+MAX_ANCESTORS = 100
+SNAPSHOT_KEYS = frozenset(['variant', 'checksum_version', 'nodes', 'attributes', 'files', 'file_blocks'])
+
+try:
+    replace = os.replace
+except AttributeError:  # python 2, os.rename doesn't overwrite on Windows
+    def replace(src, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class DirectoryStore(object):
+    """Snapshot store in a (possibly shared or CI cache) directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, *key.split('/')), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, data):
+        path = os.path.join(self.path, *key.split('/'))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        replace(path + '.tmp', path)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.path, *key.split('/')))
+
+
+class HTTPStore(object):
+    """Snapshot store on a HTTP server which answers GET and PUT of STORE_URL/key
+    (e.g. a WebDAV share, nginx with dav_methods PUT or a bucket)."""
+
+    def __init__(self, url, timeout=10):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, key):
+        try:
+            return urlopen(self.url + '/' + key, timeout=self.timeout).read()
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        except (HTTPException, socket.timeout) as e:
+            # e.g. IncompleteRead of a dropped connection, reported like the other I/O errors
+            raise IOError("{} {!r}".format(key, e))
+
+    def put(self, key, data):
+        request = Request(self.url + '/' + key, data=data)
+        request.get_method = lambda: 'PUT'
+        try:
+            urlopen(request, timeout=self.timeout).read()
+        except (HTTPException, socket.timeout) as e:
+            raise IOError("{} {!r}".format(key, e))
+
+    def __contains__(self, key):
+        return False  # objects are immutable, putting them again is harmless
+
+
+def open_store(location):
+    if location.startswith(('http://', 'https://')):
+        return HTTPStore(location)
+    return DirectoryStore(location)
+
+
+def variant_hash(variant):
+    return hashlib.md5(variant.encode('utf-8')).hexdigest()[:16]
+
+
+def ref_key(variant, commit):
+    return 'refs/{}/{}'.format(variant_hash(variant), commit)
+
+
+def write_snapshot(store, dump):
+    """Store dump (if it's not there yet) and return its key."""
+    data = json.dumps(dump, sort_keys=True).encode('utf-8')
+    key = 'objects/{}.json.zlib'.format(hashlib.sha256(data).hexdigest())
+    if key not in store:
+        store.put(key, zlib.compress(data, 9))
+    return key
+
+
+def read_snapshot(store, key):
+    """The dump stored under key, ValueError if it's missing or corrupt."""
+    data = store.get(key)
+    if data is None:
+        raise ValueError("snapshot {} is missing in the store".format(key))
+    try:
+        dump = json.loads(zlib.decompress(data).decode('utf-8'))
+    except zlib.error as e:
+        raise ValueError("snapshot {} is corrupt: {}".format(key, e))
+    if not isinstance(dump, dict) or not SNAPSHOT_KEYS.issubset(dump):
+        raise ValueError("snapshot {} is malformed".format(key))
+    return dump
+
+
+def write_ref(store, variant, commit, key):
+    store.put(ref_key(variant, commit), key.encode('utf-8'))
+
+
+def find_snapshot(store, variant, commits):
+    """Key of the snapshot of the first of commits which has one, or None."""
+    for commit in commits:
+        key = store.get(ref_key(variant, commit))
+        if key:
+            return key.decode('utf-8').strip()
+
+
+def merge_items(items, base=None):
+    """Union of the dicts in items. A key present in base and missing in some of the items was
+    removed there and is left out. Of different values the first one which differs from base
+    wins: the shards started from base and what they changed is newer."""
+    base = {} if base is None else base
+    missing = object()
+    result = {}
+    for key in set().union(*items):
+        versions = [item[key] for item in items if key in item]
+        if key in base and len(versions) < len(items):
+            continue
+        changed = [version for version in versions if base.get(key, missing) != version]
+        result[key] = changed[0] if changed else versions[0]
+    return result
+
+
+def merge(dumps, base=None):
+    for dump in dumps[1:] + ([base] if base else []):
+        if (dump['variant'], dump['checksum_version']) != (dumps[0]['variant'], dumps[0]['checksum_version']):
+            raise ValueError("can't merge snapshots of different variants or checksum versions")
+    base = base or {}
+    attributes = merge_items([dump['attributes'] for dump in dumps], base.get('attributes'))
+    file_blocks = {}
+    for dump in dumps:
+        if dump.get('python') == dumps[0].get('python'):
+            file_blocks.update(dump['file_blocks'])
+    return {'variant': dumps[0]['variant'],
+            'checksum_version': dumps[0]['checksum_version'],
+            'python': dumps[0].get('python'),
+            'nodes': merge_items([dump['nodes'] for dump in dumps], base.get('nodes')),
+            'attributes': attributes,
+            'files': merge_items([dump['files'] for dump in dumps], base.get('files')),
+            'file_blocks': file_blocks}
+
+
+def head_commits(rootdir, count=1):
+    return git(rootdir, 'rev-list', '--max-count={}'.format(count), 'HEAD').split()
+
+
+def export(testmon_data, store, commit=None):
+    key = write_snapshot(store, testmon_data.dump())
+    write_ref(store, testmon_data.variant, commit or head_commits(testmon_data.rootdir)[0], key)
+    return key
+
+
+def restore(testmon_data, store, commit=None):
+    """Replace the data of the variant by a snapshot, returns its key or None."""
+    commits = [commit] if commit else head_commits(testmon_data.rootdir, MAX_ANCESTORS)
+    key = find_snapshot(store, testmon_data.variant, commits)
+    if key:
+        testmon_data.load(read_snapshot(store, key))
+    return key
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Export, import and merge .testmondata snapshots.")
+    subparsers = parser.add_subparsers(dest='command')
+    for command in ('export', 'import', 'merge'):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument('store', help="directory or http(s) URL with the snapshots (e.g. a CI cache)")
+        subparser.add_argument('--variant', default=None, help="run variant (default: 'default')")
+        subparser.add_argument('--commit', default=None, help="default: HEAD (import: nearest ancestor)")
+        if command == 'merge':
+            subparser.add_argument('snapshots', nargs='+', help="snapshot keys of the parallel jobs")
+            subparser.add_argument('--base', default=None, help="snapshot key the jobs started from")
+        else:
+            subparser.add_argument('--rootdir', default=os.getcwd())
+    args = parser.parse_args(args)
+    if args.command is None:
+        parser.error("export, import or merge expected")
+
+    store = open_store(args.store)
+    try:
+        if args.command == 'export':
+            print(export(TestmonData(args.rootdir, variant=args.variant), store, args.commit))
+        elif args.command == 'import':
+            key = restore(TestmonData(args.rootdir, variant=args.variant), store, args.commit)
+            print(key or "no snapshot found")
+        else:
+            if not args.commit:
+                parser.error("merge needs --commit")
+            merged = merge([read_snapshot(store, key) for key in args.snapshots],
+                           read_snapshot(store, args.base) if args.base else None)
+            key = write_snapshot(store, merged)
+            write_ref(store, merged['variant'], args.commit, key)
+            print(key)
+    except subprocess.CalledProcessError:
+        sys.exit("testmon snapshot: git can't determine the commit, use --commit")
+    except (OSError, IOError, ValueError) as e:
+        sys.exit("testmon snapshot: {}".format(e))
+
+
+if __name__ == '__main__':
+    main()
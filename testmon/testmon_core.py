@@ -4,17 +4,29 @@ try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 import json
 import os
 from collections import defaultdict
 import sys
+import platform
 import textwrap
 import random
+import subprocess
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import coverage
 from testmon.process_code import checksum_coverage
 from testmon.process_code import Module
+from testmon.process_code import CHECKSUM_VERSION
+import binascii
 import hashlib
+import struct
 
 if sys.version_info > (3,):
     buffer = memoryview
@@ -39,23 +51,88 @@ def flip_dictionary(node_data):
     return files
 
 
-def unaffected(node_data, changed_files):
-    file_data = flip_dictionary(node_data)
-    unaffected_nodes = dict(node_data)
-    unaffected_files = set(file_data)
-    for file in set(changed_files) & set(file_data):
-        for nodeid, checksums in file_data[file].items():
-            if set(checksums) - set(changed_files[file].checksums):
-                affected = set(unaffected_nodes.pop(nodeid, []))
-                unaffected_files = unaffected_files - affected
-    return unaffected_nodes, unaffected_files
+def chunks(sequence, size=500):
+    sequence = list(sequence)
+    for i in range(0, len(sequence), size):
+        yield sequence[i:i + size]
+
+
+def to_bitset(positions):
+    """Python int with the bits at positions set."""
+    if not positions:
+        return 0
+    array = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        array[position >> 3] |= 1 << (position & 7)
+    return int(binascii.hexlify(bytes(array[::-1])), 16)
+
+
+def bit_positions(bitset):
+    """Positions of the set bits of a Python int, lowest first."""
+    digits = bin(bitset)[:1:-1]
+    position = digits.find('1')
+    while position != -1:
+        yield position
+        position = digits.find('1', position + 1)
+
+
+class DependencyBitsets(object):
+    """Every dependency set is a bit (its dependency_set.id), every (file, block checksum) the
+    bitset (a Python int) of the dependency sets containing it. Affected dependency sets are then
+    the union of the bitsets of the blocks which vanished from the changed files, without a set()
+    per test. The bitsets of a file are built from the dependency_block index the first time it
+    changes, the other files are never read."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.bitsets = {}
+
+    def file_bitsets(self, file_id):
+        if file_id not in self.bitsets:
+            positions = defaultdict(list)
+            for checksum, dependency_set_id in self.connection.execute(
+                    "SELECT checksum, dependency_set_id FROM dependency_block WHERE file_id=?", (file_id,)):
+                positions[checksum].append(dependency_set_id)
+            self.bitsets[file_id] = dict((checksum, to_bitset(dependency_set_ids))
+                                         for checksum, dependency_set_ids in positions.items())
+        return self.bitsets[file_id]
+
+    def vanished(self, changed_checksums):
+        """Bitsets of the blocks which are no longer in changed_checksums ({file_id: checksums})."""
+        for file_id, checksums in changed_checksums.items():
+            checksums = set(checksums)
+            for checksum, bitset in self.file_bitsets(file_id).items():
+                if checksum not in checksums:
+                    yield bitset
+
+    def affected(self, changed_checksums):
+        """Bitset of the dependency sets containing a block which is no longer in changed_checksums."""
+        result = 0
+        for bitset in self.vanished(changed_checksums):
+            result |= bitset
+        return result
+
+    def changed_blocks(self, changed_checksums):
+        """{dependency_set_id: number of the vanished blocks it contains} of the affected dependency sets."""
+        result = defaultdict(int)
+        for bitset in self.vanished(changed_checksums):
+            for position in bit_positions(bitset):
+                result[position] += 1
+        return dict(result)
 
 
 class Testmon(object):
-    def __init__(self, project_dirs, testmon_labels=set()):
+    def __init__(self, project_dirs, testmon_labels=set(), tracer='coverage'):
         self.project_dirs = project_dirs
         self.testmon_labels = testmon_labels
         self.setup_coverage(not ('singleprocess' in testmon_labels))
+        if tracer in ('lines', 'functions'):
+            from testmon.tracer import Tracer
+            self.tracer = Tracer(include=[os.path.join(path, '*') for path in self.project_dirs],
+                                 omit=_get_python_lib_paths(),
+                                 mode=tracer)
+        else:
+            self.tracer = None
 
     def setup_coverage(self, subprocess):
         includes = [os.path.join(path, '*') for path in self.project_dirs]
@@ -86,6 +163,13 @@ class Testmon(object):
             subprocess_rc.write(rc_content)
         os.environ['COVERAGE_PROCESS_START'] = self.sub_cov_file + "_rc"
 
+    def subprocess_data_written(self):
+        """True when a subprocess saved its coverage (parallel=True names the files
+        sub_cov_file.<host>.<pid>.<random>), combine() is only needed then."""
+        directory, prefix = os.path.split(self.sub_cov_file)
+        prefix += '.'
+        return any(name.startswith(prefix) for name in os.listdir(directory))
+
     def track_dependencies(self, callable_to_track, testmon_data, rootdir, nodeid):
         self.start()
         try:
@@ -96,17 +180,37 @@ class Testmon(object):
             self.stop_and_save(testmon_data, rootdir, nodeid)
 
     def start(self):
-        self.cov.erase()
-        self.cov.start()
+        if self.tracer:
+            self.tracer.start()
+        else:
+            self.cov.erase()
+            self.cov.start()
+
+    def stop(self):
+        if self.tracer:
+            self.tracer.stop()
+        else:
+            self.cov.stop()
 
     def stop_and_save(self, testmon_data, rootdir, nodeid, result=[]):
-        self.cov.stop()
-        if hasattr(self, 'sub_cov_file'):
-            self.cov.combine()
+        self.stop()
+        if self.tracer:
+            data = self.tracer.get_data()
+            if hasattr(self, 'sub_cov_file') and self.subprocess_data_written():
+                # coverage is only used to read what the subprocesses measured
+                self.cov.combine()
+                data.update(self.cov.get_data())
+                self.cov.erase()
+        else:
+            if hasattr(self, 'sub_cov_file') and self.subprocess_data_written():
+                self.cov.combine()
+            data = self.cov.get_data()
 
-        testmon_data.set_dependencies(nodeid, testmon_data.get_nodedata(nodeid, self.cov.get_data(), rootdir), result)
+        testmon_data.set_dependencies(nodeid, testmon_data.get_nodedata(nodeid, data, rootdir), result)
 
     def close(self):
+        if self.tracer:
+            self.tracer.close()
         if hasattr(self, 'sub_cov_file'):
             os.remove(self.sub_cov_file + "_rc")
         os.environ.pop('COVERAGE_PROCESS_START', None)
@@ -151,16 +255,137 @@ def parse_file(filename, rootdir, source_code):
     return Module(source_code=source_code, file_name=filename, rootdir=rootdir)
 
 
+def _getmtime(absfilename):
+    try:
+        return os.path.getmtime(absfilename)
+    except OSError:
+        return None
+
+
+def _read_file_with_checksum(absfilename):
+    try:
+        return read_file_with_checksum(absfilename)
+    except (OSError, IOError):
+        return None, None
+
+
+def _parse_file(args):
+    return parse_file(*args)
+
+
+def git(rootdir, *args):
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output(('git',) + args, cwd=rootdir, stderr=devnull)
+    return output.decode(sys.getfilesystemencoding())
+
+
+class GitState(object):
+    """HEAD commit and the files which differ from it (modified, staged or untracked)
+    in the git repository containing rootdir. All paths are relative to rootdir."""
+
+    def __init__(self, rootdir, toplevel, head, dirty):
+        self.rootdir = rootdir
+        self.toplevel = toplevel
+        self.head = head
+        self.dirty = dirty
+
+    @classmethod
+    def read(cls, rootdir):
+        """Returns None when rootdir is not in a git repository or git is not available."""
+        try:
+            toplevel = git(rootdir, 'rev-parse', '--show-toplevel').strip()
+            head = git(rootdir, 'rev-parse', 'HEAD').strip()
+            status = git(rootdir, 'status', '--porcelain', '-z', '--untracked-files=all')
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        state = cls(rootdir, toplevel, head, set())
+        entries = iter(status.split('\0'))
+        for entry in entries:
+            if not entry:
+                continue
+            state.dirty.add(state.relpath(entry[3:]))
+            if entry[0] in 'RC':
+                state.dirty.add(state.relpath(next(entries)))
+        return state
+
+    def relpath(self, path):
+        return os.path.relpath(os.path.join(self.toplevel, path), self.rootdir)
+
+    def candidates(self, previous_head, previous_dirty, filenames):
+        """Files from filenames which can differ from the last run done at previous_head
+        with previous_dirty files. Returns None when git can't tell."""
+        result = set(self.dirty) | set(previous_dirty)
+        try:
+            if previous_head != self.head:
+                result.update(self.relpath(path) for path in
+                              git(self.rootdir, 'diff', '--name-only', '-z', previous_head, self.head).split('\0')
+                              if path)
+            tracked = set(self.relpath(path) for path in
+                          git(self.rootdir, 'ls-files', '-z', '--full-name').split('\0') if path)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        result.update(filename for filename in filenames if filename not in tracked)
+        return result
+
+
+class BlockCache(object):
+    """Blocks of parsed files stored under the sha1 of the file content, so that files which
+    didn't change since the last session (or went back to an earlier version) don't have to be
+    parsed again. Block boundaries depend on the AST of the interpreter, entries are kept
+    per variant and python version."""
+
+    max_age = 30 * 24 * 3600
+
+    def __init__(self, connection, variant):
+        self.connection = connection
+        self.variant = variant
+        self.new = {}
+
+    def get(self, checksum):
+        if checksum in self.new:
+            return self.new[checksum]
+        row = self.connection.execute("SELECT blocks FROM file_blocks WHERE variant=? AND python=? AND checksum=?",
+                                      (self.variant, PYTHON_VERSION, checksum)).fetchone()
+        if row:
+            return Module.from_blocks(json.loads(row[0]))
+
+    def put(self, checksum, module):
+        self.new[checksum] = module
+
+    def write(self, keep):
+        """Store new entries and drop entries older than max_age, except the current file versions (keep)."""
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO file_blocks VALUES (?, ?, ?, ?, ?)",
+                                    [(self.variant, PYTHON_VERSION, checksum, json.dumps(module.block_tuples), now)
+                                     for checksum, module in self.new.items()])
+        self.new = {}
+        keep = set(keep)
+        self.connection.executemany("DELETE FROM file_blocks WHERE variant=? AND python=? AND checksum=?",
+                                    [row for row in
+                                     self.connection.execute("SELECT variant, python, checksum FROM file_blocks "
+                                                             "WHERE used < ?", (now - self.max_age,)).fetchall()
+                                     if row[:2] != (self.variant, PYTHON_VERSION) or row[2] not in keep])
+
+
 class SourceTree():
-    def __init__(self, rootdir, mtimes, checksums):
+    def __init__(self, rootdir, mtimes, checksums, workers=1, block_cache=None):
         self.rootdir = rootdir
         self.mtimes = mtimes
         self.checksums = checksums
+        self.block_cache = block_cache
+        self.workers = workers if workers > 0 else multiprocessing.cpu_count()
         self.changed_files = {}
 
-    def get_changed_files(self):
+    def get_changed_files(self, filenames=None):
+        """Check the files in filenames (all files in mtimes by default) for changes."""
+        if filenames is None:
+            filenames = list(self.mtimes)
+        else:
+            filenames = [filename for filename in filenames if filename in self.mtimes]
+        if self.workers > 1:
+            return self.get_changed_files_parallel(filenames)
 
-        for filename in self.mtimes:
+        for filename in filenames:
             try:
                 absfilename = os.path.join(self.rootdir, filename)
                 fs_mtime = os.path.getmtime(absfilename)
@@ -169,8 +394,7 @@ class SourceTree():
                     code, fs_checksum = read_file_with_checksum(absfilename)
                     if self.checksums.get(filename) != fs_checksum:
                         self.checksums[filename] = fs_checksum
-                        self.changed_files[filename] = parse_file(filename=filename, rootdir=self.rootdir,
-                                                                  source_code=code)
+                        self.changed_files[filename] = self.parse(filename, code, fs_checksum)
 
             except OSError:
                 pass
@@ -178,25 +402,175 @@ class SourceTree():
 
         return self.changed_files
 
+    def get_changed_files_parallel(self, filenames):
+        """Same as get_changed_files, but stats, reads and hashes the files in a pool of threads
+        and parses the changed ones in a pool of processes."""
+        chunksize = len(filenames) // (self.workers * 4) + 1
+        threads = ThreadPool(self.workers)
+        try:
+            fs_mtimes = threads.map(_getmtime,
+                                    [os.path.join(self.rootdir, filename) for filename in filenames],
+                                    chunksize)
+            modified = [(filename, fs_mtime) for filename, fs_mtime in zip(filenames, fs_mtimes)
+                        if fs_mtime is not None and self.mtimes[filename] != fs_mtime]
+            sources = threads.map(_read_file_with_checksum,
+                                  [os.path.join(self.rootdir, filename) for filename, fs_mtime in modified])
+        finally:
+            threads.close()
+            threads.join()
+
+        to_parse = []
+        for (filename, fs_mtime), (code, fs_checksum) in zip(modified, sources):
+            if fs_checksum is None:
+                continue
+            self.mtimes[filename] = fs_mtime
+            if self.checksums.get(filename) != fs_checksum:
+                self.checksums[filename] = fs_checksum
+                module = self.block_cache.get(fs_checksum) if self.block_cache else None
+                if module:
+                    self.changed_files[filename] = module
+                else:
+                    to_parse.append((filename, self.rootdir, code))
+
+        if len(to_parse) > 1:
+            processes = multiprocessing.Pool(min(self.workers, len(to_parse)))
+            try:
+                modules = processes.map(_parse_file, to_parse)
+            finally:
+                processes.close()
+                processes.join()
+        else:
+            modules = [_parse_file(args) for args in to_parse]
+
+        for (filename, rootdir, code), module in zip(to_parse, modules):
+            self.changed_files[filename] = module
+            if self.block_cache:
+                self.block_cache.put(self.checksums[filename], module)
+        return self.changed_files
+
+    def parse(self, filename, code, checksum):
+        module = self.block_cache.get(checksum) if self.block_cache else None
+        if module is None:
+            module = parse_file(filename=filename, rootdir=self.rootdir, source_code=code)
+            if self.block_cache:
+                self.block_cache.put(checksum, module)
+        return module
+
+    def apply_changes(self, files):
+        """Take over {filename: {'mtime': .., 'checksum': .., 'blocks': [..]}} observed by testmon.daemon
+        instead of checking the files."""
+        for filename, info in files.items():
+            if filename in self.mtimes:
+                self.mtimes[filename] = info['mtime']
+                if self.checksums.get(filename) != info['checksum']:
+                    self.checksums[filename] = info['checksum']
+                    self.changed_files[filename] = Module.from_blocks(info['blocks'])
+        return self.changed_files
+
     def get_file(self, filename):
         if filename not in self.changed_files:
             code, checksum = read_file_with_checksum(os.path.join(self.rootdir, filename))
             self.mtimes[filename] = os.path.getmtime(os.path.join(self.rootdir, filename))
             self.checksums[filename] = checksum
-            self.changed_files[filename] = parse_file(filename=filename, rootdir=self.rootdir, source_code=code)
+            self.changed_files[filename] = self.parse(filename, code, checksum)
         return self.changed_files[filename]
 
 
+DATA_VERSION = 8
+PYTHON_VERSION = '{} {}'.format(platform.python_implementation(), '.'.join(map(str, sys.version_info[:3])))
+
+
+def pack_checksums(checksums):
+    return buffer(struct.pack('<%dI' % len(checksums), *checksums))
+
+
+def unpack_checksums(blob):
+    blob = bytes(blob)
+    return list(struct.unpack('<%dI' % (len(blob) // 4), blob))
+
+
+def dependency_set_hash(nodedata):
+    return hashlib.sha1(encode(json.dumps(nodedata, sort_keys=True))).hexdigest()
+
+
+class LazyNodeData(MutableMapping):
+    """node_data backed by the dependency_file table. Only the names of the nodes are read
+    up front, dependencies of a node are loaded (and cached) when it's accessed. Nodes with
+    the same dependency set share one dict."""
+
+    def __init__(self, connection, variant):
+        self.connection = connection
+        self.variant = variant
+        self.cache = {}
+        self.dependency_sets = {}
+        self.file_names = {}
+        self._nodeids = None
+
+    @property
+    def nodeids(self):
+        if self._nodeids is None:
+            self._nodeids = set(row[0] for row in self.connection.execute("SELECT name FROM node WHERE variant=?",
+                                                                          (self.variant,)))
+        return self._nodeids
+
+    def __getitem__(self, nodeid):
+        if nodeid not in self.cache:
+            if nodeid not in self.nodeids:
+                raise KeyError(nodeid)
+            dependency_set_id = self.connection.execute("SELECT dependency_set_id FROM node "
+                                                        "WHERE variant=? AND name=?",
+                                                        (self.variant, nodeid)).fetchone()[0]
+            if dependency_set_id not in self.dependency_sets:
+                self.dependency_sets[dependency_set_id] = dict(
+                    (self.file_name(file_id), unpack_checksums(checksums)) for file_id, checksums in
+                    self.connection.execute("SELECT file_id, checksums FROM dependency_file "
+                                            "WHERE dependency_set_id=?", (dependency_set_id,)))
+            self.cache[nodeid] = self.dependency_sets[dependency_set_id]
+        return self.cache[nodeid]
+
+    def file_name(self, file_id):
+        """All the nodes share one string per file."""
+        if file_id not in self.file_names:
+            self.file_names[file_id] = self.connection.execute("SELECT name FROM file WHERE id=?",
+                                                               (file_id,)).fetchone()[0]
+        return self.file_names[file_id]
+
+    def __setitem__(self, nodeid, node_files):
+        self.nodeids.add(nodeid)
+        self.cache[nodeid] = node_files
+
+    def __delitem__(self, nodeid):
+        self.nodeids.remove(nodeid)
+        self.cache.pop(nodeid, None)
+
+    def __contains__(self, nodeid):
+        return nodeid in self.nodeids
+
+    def __iter__(self):
+        return iter(self.nodeids)
+
+    def __len__(self):
+        return len(self.nodeids)
+
+
 class TestmonData(object):
-    def __init__(self, rootdir, variant=None):
+    def __init__(self, rootdir, variant=None, flush_interval=0, synchronous='NORMAL'):
 
         self.variant = variant if variant else 'default'
         self.rootdir = rootdir
-        self.init_connection()
+        self.file_ids = {}
+        self.flush_interval = flush_interval
+        self.pending_dependencies = []
+        self.last_flush = time.time()
+        self.init_connection(synchronous)
         self.node_data = {}
+        self.durations = None
+        self.changed_blocks = {}
+        self._module_nodeids = None
+        self.stored_fingerprints = None
         self.reports = defaultdict(lambda: [])
 
-    def init_connection(self):
+    def init_connection(self, synchronous='NORMAL'):
         self.datafile = os.path.join(self.rootdir, '.testmondata')
         self.connection = None
         import sqlite3
@@ -207,8 +581,14 @@ class TestmonData(object):
             self.newfile = True
         self.connection = sqlite3.connect(self.datafile)
         self.connection.execute("PRAGMA recursive_triggers = TRUE ")
+        self.connection.execute("PRAGMA foreign_keys = TRUE ")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = {}".format(synchronous))
         if getattr(self, 'newfile', False):
             self.init_tables()
+        else:
+            self.upgrade_tables()
+        self.check_checksum_version()
 
     def _fetch_attribute(self, attribute, default=None):
         cursor = self.connection.execute("SELECT data FROM metadata WHERE dataid=?",
@@ -220,22 +600,93 @@ class TestmonData(object):
             return default
 
     def _fetch_node_data(self):
+        """Every dependency set is read once, the nodes referencing it share the dict
+        (and all the dicts one string per file name)."""
+        file_names = dict(self.connection.execute("SELECT id, name FROM file"))
+        dependency_sets = defaultdict(lambda: {})
+        for dependency_set_id, file_id, checksums in self.connection.execute(
+                """SELECT dependency_set_id, file_id, checksums
+                   FROM dependency_file
+                   WHERE dependency_set_id IN
+                     (SELECT dependency_set_id FROM node WHERE variant=?)""", (self.variant,)):
+            dependency_sets[dependency_set_id][file_names[file_id]] = unpack_checksums(checksums)
         dependencies = defaultdict(lambda: {})
-        for row in self.connection.execute("""SELECT
-                                                node_name,
-                                                file_name,
-                                                checksums
-                                              FROM node_file WHERE node_variant=?""",
-                                           (self.variant,)):
-            dependencies[row[0]][row[1]] = json.loads(row[2])
+        for nodeid, dependency_set_id in self.connection.execute("SELECT name, dependency_set_id FROM node "
+                                                                 "WHERE variant=?", (self.variant,)):
+            if dependency_set_id in dependency_sets:
+                dependencies[nodeid] = dependency_sets[dependency_set_id]
 
+        return dependencies, self._fetch_fail_reports()
+
+    def _fetch_fail_reports(self):
         fail_reports = defaultdict(lambda: {})
 
         for row in self.connection.execute('SELECT name, result FROM node WHERE variant=? AND failed=1',
                                            (self.variant,)):
             fail_reports[row[0]] = json.loads(row[1])
 
-        return dependencies, fail_reports
+        return fail_reports
+
+    def _file_id(self, filename, create=True):
+        if filename not in self.file_ids:
+            row = self.connection.execute("SELECT id FROM file WHERE name=?", (filename,)).fetchone()
+            if row:
+                self.file_ids[filename] = row[0]
+            elif create:
+                self.file_ids[filename] = self.connection.execute("INSERT INTO file (name) VALUES (?)",
+                                                                  (filename,)).lastrowid
+            else:
+                return None
+        return self.file_ids[filename]
+
+    def _write_node(self, nodeid, result, failed, duration=None):
+        row = self.connection.execute("SELECT id FROM node WHERE variant=? AND name=?",
+                                      (self.variant, nodeid)).fetchone()
+        if row:
+            self.connection.execute("UPDATE node SET result=?, failed=?, duration=? WHERE id=?",
+                                    (result, failed, duration, row[0]))
+            return row[0]
+        else:
+            return self.connection.execute("INSERT INTO node (variant, name, result, failed, duration) "
+                                           "VALUES (?, ?, ?, ?, ?)",
+                                           (self.variant, nodeid, result, failed, duration)).lastrowid
+
+    def _dependency_set_id(self, nodedata):
+        """id of the dependency set with the content of nodedata, stored when it's new."""
+        content_hash = dependency_set_hash(nodedata)
+        row = self.connection.execute("SELECT id FROM dependency_set WHERE hash=?", (content_hash,)).fetchone()
+        if row:
+            return row[0]
+        dependency_set_id = self.connection.execute("INSERT INTO dependency_set (hash) VALUES (?)",
+                                                    (content_hash,)).lastrowid
+        set_files = [(self._file_id(filename), checksums) for filename, checksums in nodedata.items()]
+        self.connection.executemany("INSERT INTO dependency_file VALUES (?, ?, ?)",
+                                    [(dependency_set_id, file_id, pack_checksums(checksums))
+                                     for file_id, checksums in set_files])
+        self.connection.executemany("INSERT INTO dependency_block VALUES (?, ?, ?)",
+                                    [(file_id, checksum, dependency_set_id)
+                                     for file_id, checksums in set_files
+                                     for checksum in set(checksums)])
+        return dependency_set_id
+
+    def _write_dependencies(self, dependencies):
+        """Point the nodes of [(node_id, nodedata), ...] to their dependency sets. Identical nodedata
+        (e.g. of parametrized tests) is stored once, under the sha1 of its content."""
+        previous = set()
+        for node_id, nodedata in dependencies:
+            previous.add(self.connection.execute("SELECT dependency_set_id FROM node WHERE id=?",
+                                                 (node_id,)).fetchone()[0])
+        self.connection.executemany("UPDATE node SET dependency_set_id=? WHERE id=?",
+                                    [(self._dependency_set_id(nodedata), node_id)
+                                     for node_id, nodedata in dependencies])
+        self.connection.executemany("""DELETE FROM dependency_set WHERE id=? AND NOT EXISTS
+                                         (SELECT 1 FROM node WHERE dependency_set_id=?)""",
+                                    [(dependency_set_id, dependency_set_id) for dependency_set_id in previous
+                                     if dependency_set_id is not None])
+
+    def remove_unused_dependency_sets(self):
+        self.connection.execute("""DELETE FROM dependency_set WHERE NOT EXISTS
+                                     (SELECT 1 FROM node WHERE node.dependency_set_id = dependency_set.id)""")
 
     def _write_attribute(self, attribute, data):
         dataid = self.variant + ':' + attribute
@@ -251,35 +702,279 @@ class TestmonData(object):
         self.connection.execute('CREATE TABLE metadata (dataid TEXT PRIMARY KEY, data TEXT)')
         self.connection.execute("""
           CREATE TABLE node (
+              id INTEGER PRIMARY KEY,
               variant TEXT,
               name TEXT,
               result TEXT,
               failed BIT,
-              PRIMARY KEY (variant, name))
+              duration REAL,
+              dependency_set_id INTEGER REFERENCES dependency_set(id),
+              UNIQUE (variant, name))
+""")
+        self.connection.execute("""
+          CREATE TABLE file (
+              id INTEGER PRIMARY KEY,
+              name TEXT UNIQUE)
 """)
+        self.init_dependency_sets()
+        self.init_file_blocks()
+        self.init_file_fingerprint()
+        self.connection.execute("PRAGMA user_version = {}".format(DATA_VERSION))
+
+    def init_dependency_sets(self):
+        # Dependencies ({file: checksums}) are stored once per distinct content, nodes reference them
+        # by node.dependency_set_id.
+        self.connection.execute("""
+          CREATE TABLE dependency_set (
+            id INTEGER PRIMARY KEY,
+            hash TEXT UNIQUE)
+    """)
+        self.connection.execute("""
+          CREATE TABLE dependency_file (
+            dependency_set_id INTEGER REFERENCES dependency_set(id) ON DELETE CASCADE,
+            file_id INTEGER REFERENCES file(id),
+            checksums BLOB,
+            PRIMARY KEY (dependency_set_id, file_id))
+    """)
+        # dependency_block is the inverted index of dependency_file: (file, block checksum) -> dependency set.
+        # It lets compute_unaffected look up only the blocks which disappeared from the changed files.
         self.connection.execute("""
-          CREATE TABLE node_file (
-            node_variant TEXT,
-            node_name TEXT,
-            file_name TEXT,
-            checksums TEXT,
-            FOREIGN KEY(node_variant, node_name) REFERENCES node(variant, name) ON DELETE CASCADE)
+          CREATE TABLE dependency_block (
+            file_id INTEGER,
+            checksum INTEGER,
+            dependency_set_id INTEGER REFERENCES dependency_set(id) ON DELETE CASCADE)
     """)
+        self.connection.execute("CREATE INDEX dependency_block_checksum ON dependency_block (file_id, checksum)")
+        self.connection.execute("CREATE INDEX dependency_block_set ON dependency_block (dependency_set_id)")
+        self.connection.execute("CREATE INDEX node_dependency_set ON node (dependency_set_id)")
 
-    def read_data(self):
-        self.node_data, self.fail_reports = self._fetch_node_data()
+    def init_file_blocks(self):
+        self.connection.execute("""
+          CREATE TABLE file_blocks (
+            variant TEXT,
+            python TEXT,
+            checksum TEXT,
+            blocks TEXT,
+            used REAL,
+            PRIMARY KEY (variant, python, checksum))
+    """)
+
+    def init_file_fingerprint(self):
+        # mtime and sha1 of every file of the source tree, only the rows of files which changed are written
+        self.connection.execute("""
+          CREATE TABLE file_fingerprint (
+            variant TEXT,
+            name TEXT,
+            mtime REAL,
+            checksum TEXT,
+            PRIMARY KEY (variant, name))
+    """)
+
+    def upgrade_tables(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < 3:
+            self.migrate_denormalized_tables()
+            self.connection.execute("VACUUM")
+        elif version < DATA_VERSION:
+            with self.connection:
+                if version < 5:
+                    self.connection.execute("ALTER TABLE node ADD COLUMN duration REAL")
+                if version < 6:
+                    self.init_file_fingerprint()
+                    self.migrate_fingerprints()
+                if version < 7:
+                    self.migrate_dependency_sets()
+                if version < 8:
+                    # the cache is rebuilt by the next run
+                    self.connection.execute("DROP TABLE IF EXISTS file_blocks")
+                    self.init_file_blocks()
+                self.connection.execute("PRAGMA user_version = {}".format(DATA_VERSION))
+
+    def check_checksum_version(self):
+        """Block checksums computed by a different version of process_code can't be compared,
+        all the dependencies (and cached blocks) are dropped and the tests run again."""
+        row = self.connection.execute("SELECT data FROM metadata WHERE dataid='checksum_version'").fetchone()
+        if (json.loads(row[0]) if row else 1) != CHECKSUM_VERSION:
+            with self.connection:
+                self.connection.execute("DELETE FROM node")
+                self.connection.execute("DELETE FROM dependency_set")
+                self.connection.execute("DELETE FROM file_blocks")
+                self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('checksum_version', ?)",
+                                        (json.dumps(CHECKSUM_VERSION),))
+
+    def migrate_denormalized_tables(self):
+        """Data versions < 3 stored variant, node and file names as strings and the checksums
+        as JSON in every node_file row."""
+        with self.connection as con:
+            row = con.execute("SELECT data FROM metadata WHERE dataid='checksum_version'").fetchone()
+            nodes, dependencies = [], defaultdict(lambda: {})
+            # nodes of an older checksum version are dropped by check_checksum_version anyway
+            if (json.loads(row[0]) if row else 1) == CHECKSUM_VERSION:
+                nodes = con.execute("SELECT variant, name, result, failed FROM node").fetchall()
+                for node_variant, node_name, file_name, checksums in con.execute(
+                        "SELECT node_variant, node_name, file_name, checksums FROM node_file ORDER BY rowid"):
+                    # python 2 stored signed checksums
+                    dependencies[(node_variant, node_name)][file_name] = [checksum & 0xffffffff for checksum
+                                                                          in json.loads(checksums)]
+            metadata = con.execute("SELECT dataid, data FROM metadata").fetchall()
+            for table in ('node_block', 'node_file', 'node', 'metadata'):
+                con.execute("DROP TABLE IF EXISTS {}".format(table))
+            self.init_tables()
+            con.executemany("INSERT INTO metadata VALUES (?, ?)", metadata)
+            self.migrate_fingerprints()
+            self._write_dependencies([(con.execute("INSERT INTO node (variant, name, result, failed) "
+                                                   "VALUES (?, ?, ?, ?)", (variant, name, result, failed)).lastrowid,
+                                       dependencies[(variant, name)])
+                                      for variant, name, result, failed in nodes])
+
+    def migrate_dependency_sets(self):
+        """Data versions < 7 stored the checksums of every node and file in node_file (and node_block)."""
+        dependencies = defaultdict(lambda: {})
+        for node_id, file_name, checksums in self.connection.execute(
+                """SELECT node_file.node_id, file.name, node_file.checksums
+                   FROM node_file JOIN file ON file.id = node_file.file_id""").fetchall():
+            dependencies[node_id][file_name] = unpack_checksums(checksums)
+        self.connection.execute("DROP TABLE node_block")
+        self.connection.execute("DROP TABLE node_file")
+        self.connection.execute("ALTER TABLE node ADD COLUMN dependency_set_id INTEGER REFERENCES dependency_set(id)")
+        self.init_dependency_sets()
+        self._write_dependencies(sorted(dependencies.items()))
+
+    def migrate_fingerprints(self):
+        """Data versions < 6 stored mtimes and file_checksums of a variant as two JSON dicts in metadata."""
+        for dataid, data in self.connection.execute("SELECT dataid, data FROM metadata "
+                                                    "WHERE dataid LIKE '%:mtimes'").fetchall():
+            variant = dataid[:-len(':mtimes')]
+            row = self.connection.execute("SELECT data FROM metadata WHERE dataid=?",
+                                          (variant + ':file_checksums',)).fetchone()
+            checksums = json.loads(row[0]) if row else {}
+            self.connection.executemany("INSERT OR REPLACE INTO file_fingerprint VALUES (?, ?, ?, ?)",
+                                        [(variant, name, mtime, checksums.get(name))
+                                         for name, mtime in json.loads(data).items()])
+            self.connection.executemany("DELETE FROM metadata WHERE dataid=?",
+                                        [(dataid,), (variant + ':file_checksums',)])
+
+    def _fetch_fingerprints(self):
+        """{filename: (mtime, checksum)}"""
+        return dict((name, (mtime, checksum)) for name, mtime, checksum in
+                    self.connection.execute("SELECT name, mtime, checksum FROM file_fingerprint WHERE variant=?",
+                                            (self.variant,)))
+
+    def _write_fingerprints(self, fingerprints):
+        self.connection.executemany("INSERT OR REPLACE INTO file_fingerprint VALUES (?, ?, ?, ?)",
+                                    [(self.variant, name, mtime, checksum)
+                                     for name, (mtime, checksum) in fingerprints.items()])
+
+    def read_data(self, lazy=False):
+        if lazy:
+            self.node_data = LazyNodeData(self.connection, self.variant)
+            self.fail_reports = self._fetch_fail_reports()
+        else:
+            self.node_data, self.fail_reports = self._fetch_node_data()
+
+    def has_data(self):
+        return self.connection.execute("SELECT 1 FROM node WHERE variant=? LIMIT 1",
+                                       (self.variant,)).fetchone() is not None
+
+    def dump(self):
+        """All data of the variant as a JSON serializable dict, see testmon.snapshot."""
+        node_data = self._fetch_node_data()[0]
+        nodes = {}
+        for name, result, failed, duration in self.connection.execute(
+                "SELECT name, result, failed, duration FROM node WHERE variant=?", (self.variant,)):
+            nodes[name] = {'result': result, 'failed': bool(failed), 'duration': duration,
+                           'files': node_data.get(name, {})}
+        prefix = self.variant + ':'
+        attributes = dict((dataid[len(prefix):], json.loads(data))
+                          for dataid, data in self.connection.execute("SELECT dataid, data FROM metadata")
+                          if dataid.startswith(prefix) and dataid != prefix + 'daemon')
+        file_blocks = dict((checksum, json.loads(blocks))
+                           for checksum, blocks in self.connection.execute("SELECT checksum, blocks FROM file_blocks "
+                                                                           "WHERE variant=? AND python=?",
+                                                                           (self.variant, PYTHON_VERSION)))
+        return {'variant': self.variant,
+                'checksum_version': CHECKSUM_VERSION,
+                'python': PYTHON_VERSION,
+                'nodes': nodes,
+                'attributes': attributes,
+                'files': dict((name, list(fingerprint)) for name, fingerprint in self._fetch_fingerprints().items()),
+                'file_blocks': file_blocks}
+
+    def load(self, dump):
+        """Replace all data of the variant by dump(), ValueError if dump is malformed."""
+        try:
+            if dump['checksum_version'] != CHECKSUM_VERSION:
+                raise ValueError("checksum version {} of the data differs from {}".format(dump['checksum_version'],
+                                                                                          CHECKSUM_VERSION))
+            with self.connection:
+                self.connection.execute("DELETE FROM node WHERE variant=?", (self.variant,))
+                self.remove_unused_dependency_sets()
+                self._write_dependencies([(self._write_node(name, node['result'], node['failed'], node['duration']),
+                                           node['files'])
+                                          for name, node in sorted(dump['nodes'].items())])
+                for attribute, data in dump['attributes'].items():
+                    self._write_attribute(attribute, data)
+                self.connection.execute("DELETE FROM file_fingerprint WHERE variant=?", (self.variant,))
+                self._write_fingerprints(dict((name, tuple(fingerprint))
+                                              for name, fingerprint in dump['files'].items()))
+                if dump.get('python') == PYTHON_VERSION:
+                    now = time.time()
+                    self.connection.executemany("INSERT OR REPLACE INTO file_blocks VALUES (?, ?, ?, ?, ?)",
+                                                [(self.variant, PYTHON_VERSION, checksum, json.dumps(blocks), now)
+                                                 for checksum, blocks in dump['file_blocks'].items()])
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError("malformed snapshot: {!r}".format(e))
+
+    def get_durations(self):
+        """{nodeid: seconds} of the last run of every test (setup, call and teardown together)."""
+        if self.durations is None:
+            self.durations = dict(self.connection.execute("SELECT name, duration FROM node "
+                                                          "WHERE variant=? AND duration IS NOT NULL",
+                                                          (self.variant,)))
+        return self.durations
+
+    def xdist_state(self):
+        """What the xdist workers get from the controller instead of checking the files themselves."""
+        return {'unaffected_nodeids': sorted(self.unaffected_nodeids),
+                'unaffected_files': sorted(self.unaffected_files),
+                'durations': self.durations,
+                'changed_blocks': self.changed_blocks}
+
+    def load_xdist_state(self, state):
+        self.unaffected_nodeids = set(state['unaffected_nodeids'])
+        self.unaffected_files = set(state['unaffected_files'])
+        self.durations = state.get('durations')
+        self.changed_blocks = state.get('changed_blocks', {})
+        self.block_cache = BlockCache(self.connection, self.variant)
+        self.source_tree = SourceTree(rootdir=self.rootdir, mtimes={}, checksums={}, block_cache=self.block_cache)
+        self.stored_fingerprints = {}
 
     def write_data(self):
         with self.connection:
             if hasattr(self, 'source_tree'):
-                self._write_attribute('mtimes', self.source_tree.mtimes)
-                self._write_attribute('file_checksums', self.source_tree.checksums)
+                fingerprints = dict((filename, (mtime, self.source_tree.checksums.get(filename)))
+                                    for filename, mtime in self.source_tree.mtimes.items())
+                self._write_fingerprints(dict((filename, fingerprint)
+                                              for filename, fingerprint in fingerprints.items()
+                                              if self.stored_fingerprints.get(filename) != fingerprint))
+                self.stored_fingerprints = fingerprints
+                self.block_cache.write(self.source_tree.checksums.values())
+            if getattr(self, 'daemon_state', None):
+                self._write_attribute('daemon', self.daemon_state)
+            if getattr(self, 'git_state', None):
+                self._write_attribute('git', {'head': self.git_state.head,
+                                              'dirty': sorted(self.git_state.dirty)})
 
     def collect_garbage(self, removed_nodeids):
         for removed_nodeid in removed_nodeids:
             self.node_data.pop(removed_nodeid, None)
+            if self._module_nodeids is not None:
+                module_nodeids = self._module_nodeids.get(removed_nodeid.split('::', 1)[0], [])
+                if removed_nodeid in module_nodeids:
+                    module_nodeids.remove(removed_nodeid)
         self.connection.executemany('DELETE FROM node WHERE variant=? AND name=?',
                                     [(self.variant, removed_nodeid) for removed_nodeid in removed_nodeids])
+        self.remove_unused_dependency_sets()
 
     def repr_per_node(self, key):
         return "{}: {}\n".format(key,
@@ -296,40 +991,119 @@ class TestmonData(object):
     def file_data(self):
         return flip_dictionary(self.node_data)
 
+    def module_nodeids(self):
+        """{test module: nodeids of the known tests in it}, read once from the node table
+        without loading any dependencies (the module is the part of the nodeid before '::')."""
+        if self._module_nodeids is None:
+            self._module_nodeids = defaultdict(list)
+            for (nodeid,) in self.connection.execute("SELECT name FROM node WHERE variant=? ORDER BY id",
+                                                     (self.variant,)):
+                self._module_nodeids[nodeid.split('::', 1)[0]].append(nodeid)
+        return self._module_nodeids
+
+    def file_nodeids(self):
+        """{file: nodeids of the tests depending on it} straight from dependency_file."""
+        result = defaultdict(list)
+        for filename, nodeid in self.connection.execute("""SELECT file.name, node.name
+                                                           FROM node
+                                                             JOIN dependency_file
+                                                               ON dependency_file.dependency_set_id
+                                                                  = node.dependency_set_id
+                                                             JOIN file ON file.id = dependency_file.file_id
+                                                           WHERE node.variant=?""", (self.variant,)):
+            result[filename].append(nodeid)
+        return result
+
     def get_nodedata(self, nodeid, coverage_data, rootdir):
         result = {}
         for filename in coverage_data.measured_files():
             relfilename = os.path.relpath(filename, rootdir)
             lines = coverage_data.lines(filename)
             if os.path.exists(filename):
-                result[relfilename] = checksum_coverage(self.source_tree.get_file(relfilename).blocks, lines)
+                result[relfilename] = checksum_coverage(self.source_tree.get_file(relfilename).table, lines)
         if not result:  # when testmon kicks-in the test module is already imported. If the test function is skipped
             # coverage_data is empty. However, we need to write down, that we depend on the
             # file where the test is stored (so that we notice e.g. when the test is no longer skipped.)
             relfilename = os.path.relpath(os.path.join(rootdir, nodeid).split("::", 1)[0], self.rootdir)
-            result[relfilename] = checksum_coverage(self.source_tree.get_file(relfilename).blocks, [1])
+            result[relfilename] = checksum_coverage(self.source_tree.get_file(relfilename).table, [1])
         return result
 
     def set_dependencies(self, nodeid, nodedata, result=[]):
-        with self.connection as con:
-            outcome = bool([True for r in result if r.get('outcome') == u'failed'])
-            con.execute("INSERT OR REPLACE INTO "
-                        "node "
-                        "VALUES (?, ?, ?, ?)",
-                        (self.variant, nodeid, json.dumps(result) if outcome else '', outcome))
-            con.executemany("INSERT INTO node_file VALUES (?, ?, ?, ?)",
-                            [(self.variant, nodeid, filename, json.dumps(nodedata[filename])) for filename in nodedata])
+        """Dependencies are buffered and written every flush_interval seconds
+        (immediately with the default of 0) to save a transaction per test."""
+        self.pending_dependencies.append((nodeid, nodedata, result))
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
 
-    def read_source(self):
-        mtimes = self._fetch_attribute('mtimes', default={})
-        checksums = self._fetch_attribute('file_checksums', default={})
+    def flush(self):
+        if self.pending_dependencies:
+            with self.connection:
+                dependencies = []
+                for nodeid, nodedata, result in self.pending_dependencies:
+                    outcome = bool([True for r in result if r.get('outcome') == u'failed'])
+                    duration = sum(r.get('duration') or 0 for r in result) if result else None
+                    dependencies.append((self._write_node(nodeid, json.dumps(result) if outcome else '', outcome,
+                                                          duration),
+                                         nodedata))
+                self._write_dependencies(dependencies)
+            self.pending_dependencies = []
+        self.last_flush = time.time()
 
-        self.source_tree = SourceTree(rootdir=self.rootdir, mtimes=mtimes, checksums=checksums)
-        self.compute_unaffected(self.source_tree.get_changed_files())
+    def read_source(self, workers=1, use_git=False, use_daemon=False):
+        self.stored_fingerprints = self._fetch_fingerprints()
+        mtimes = dict((filename, mtime) for filename, (mtime, checksum) in self.stored_fingerprints.items())
+        checksums = dict((filename, checksum) for filename, (mtime, checksum) in self.stored_fingerprints.items())
 
-    def compute_unaffected(self, changed_files):
-        self.unaffected_nodeids, self.unaffected_files = unaffected(self.node_data, changed_files)
+        self.block_cache = BlockCache(self.connection, self.variant)
+        self.source_tree = SourceTree(rootdir=self.rootdir, mtimes=mtimes, checksums=checksums, workers=workers,
+                                      block_cache=self.block_cache)
+        if use_daemon:
+            from testmon.daemon import query
+            previous = self._fetch_attribute('daemon', default={})
+            response = query(self.rootdir, previous.get('id'), previous.get('generation', 0))
+            if response:
+                self.daemon_state = {'id': response['daemon'], 'generation': response['generation']}
+                if response['files'] is not None:
+                    self.compute_unaffected(self.source_tree.apply_changes(response['files']))
+                    return
+        candidates = None
+        if use_git:
+            self.git_state = GitState.read(self.rootdir)
+            previous = self._fetch_attribute('git')
+            if self.git_state and previous:
+                candidates = self.git_state.candidates(previous['head'], previous['dirty'], mtimes)
+        self.compute_unaffected(self.source_tree.get_changed_files(candidates))
+
+    def affected_nodeids(self, changed_files):
+        """{nodeid: number of the blocks it depends on which changed} of the affected tests. Only the
+        dependency_block rows of the changed files and the nodes of the affected dependency sets are read."""
+        changed_checksums = {}
+        for filename, module in changed_files.items():
+            file_id = self._file_id(filename, create=False)
+            if file_id is not None:
+                changed_checksums[file_id] = module.checksums
+        changed_blocks = DependencyBitsets(self.connection).changed_blocks(changed_checksums)
+        affected = {}
+        for chunk in chunks(changed_blocks):
+            # the variant is compared here, with it in the WHERE clause sqlite would scan all nodes of the variant
+            for nodeid, variant, dependency_set_id in self.connection.execute(
+                    "SELECT name, variant, dependency_set_id FROM node WHERE dependency_set_id IN ({})".format(
+                        ", ".join("?" * len(chunk))), chunk):
+                if variant == self.variant:
+                    affected[nodeid] = changed_blocks[dependency_set_id]
+        return affected
 
-        # possible data structures
-        # nodeid1 -> [filename -> [block_a, block_b]]
-        # filename -> [block_a -> [nodeid1, ], block_b -> [nodeid1], block_c -> [] ]
+    def compute_unaffected(self, changed_files):
+        self.changed_blocks = self.affected_nodeids(changed_files)
+        affected = set(self.changed_blocks)
+        self.unaffected_nodeids = set(self.node_data) - affected
+        # a changed file can have new tests even if no known test is affected
+        affected_files = set(changed_files)
+        for nodeid in affected:
+            affected_files.update(self.node_data.get(nodeid, {}))
+        # every file with a fingerprint was a dependency of a recorded test, files which were never
+        # recorded (e.g. the session was interrupted) have to be collected
+        fingerprints = self.stored_fingerprints
+        if fingerprints is None:
+            fingerprints = self._fetch_fingerprints()
+        self.unaffected_files = set(fingerprints) - affected_files
@@ -0,0 +1,196 @@
+"""
+Tracer used instead of coverage.py for the per test measurement (--testmon-tracer=lines|functions).
+
+coverage.py is built to measure whole runs, testmon erases, starts, stops and reads
+its data around every test. Tracer stays installed for the whole session and between
+tests only swaps the set of recorded lines. Every line is recorded only the first time
+it runs in a test: with sys.monitoring (python 3.12+) the LINE event of an already seen
+line is disabled until the next test, with sys.settrace a code object whose lines have
+all been seen stops being traced. sys.monitoring doesn't fire LINE events for one-line
+functions on python 3.13, so entering a code object is recorded (as in 'functions' mode)
+too.
+
+In 'functions' mode only entering a code object is recorded (PY_START events or the
+'call' events of sys.settrace, no line events at all). Instead of the lines which ran the
+code object is represented by all the lines of its body (nested functions have their own
+code objects), which is enough for checksum_coverage to find the Block of the function
+and all the blocks around it.
+"""
+import dis
+import fnmatch
+import functools
+import operator
+import os
+import sys
+import threading
+from collections import defaultdict
+
+
+class TracerData(object):
+    """The part of coverage.CoverageData which TestmonData.get_nodedata uses."""
+
+    def __init__(self, lines):
+        self._lines = lines
+
+    def measured_files(self):
+        return list(self._lines)
+
+    def lines(self, filename):
+        return sorted(self._lines.get(filename, ()))
+
+    def update(self, coverage_data):
+        for filename in coverage_data.measured_files():
+            self._lines.setdefault(filename, set()).update(coverage_data.lines(filename) or ())
+
+
+def code_lines(code):
+    return set(lineno for offset, lineno in dis.findlinestarts(code) if lineno is not None)
+
+
+# instructions on the def line of a function (python 3.11+), they don't get a 'line' event
+PROLOGUE = frozenset(['RESUME', 'RETURN_GENERATOR', 'POP_TOP', 'MAKE_CELL', 'COPY_FREE_VARS'])
+
+
+def traced_lines(code):
+    """code_lines which get 'line' events from sys.settrace. co_firstlineno holds only the
+    prologue of a function on python 3.11+, unless the whole function is on one line."""
+    lines = code_lines(code)
+    if sys.version_info >= (3, 11) and code.co_firstlineno in lines:
+        if all(instruction.opname in PROLOGUE for instruction in dis.get_instructions(code)
+               if instruction.positions.lineno == code.co_firstlineno):
+            lines.discard(code.co_firstlineno)
+    return lines
+
+
+def body_lines(code):
+    """Lines of the body of code: the lines after co_firstlineno (the def line, or the first
+    decorator) with some bytecode, co_firstlineno itself for one-liners. The first of them
+    isn't enough, it can be a decorator of a nested function or class, which lies before the
+    Block of the body."""
+    return frozenset([lineno for lineno in code_lines(code) if lineno > code.co_firstlineno] or
+                     [code.co_firstlineno])
+
+
+class Tracer(object):
+    def __init__(self, include, omit, mode='lines'):
+        self.include = include
+        self.omit = omit
+        self.mode = mode
+        self.filenames = {}
+        self.code_lines = {}
+        self.entry_lines = {}
+        self.lines = defaultdict(set)
+        self.monitoring = getattr(sys, 'monitoring', None)
+        self.tool_id = None
+
+    def tracked_filename(self, code):
+        """Absolute filename of the code if it matches include and not omit, otherwise None."""
+        co_filename = code.co_filename
+        if co_filename not in self.filenames:
+            filename = os.path.abspath(co_filename)
+            if (any(fnmatch.fnmatch(filename, pattern) for pattern in self.include) and
+                    not any(fnmatch.fnmatch(filename, pattern) for pattern in self.omit)):
+                self.filenames[co_filename] = filename
+            else:
+                self.filenames[co_filename] = None
+        return self.filenames[co_filename]
+
+    def start(self):
+        self.lines = defaultdict(set)
+        if self.monitoring:
+            self._start_monitoring()
+        else:
+            self.remaining = {}
+            trace = self._settrace_call if self.mode == 'lines' else self._settrace_function
+            threading.settrace(trace)
+            sys.settrace(trace)
+
+    def stop(self):
+        if self.monitoring:
+            self.monitoring.set_events(self.tool_id, 0)
+        else:
+            sys.settrace(None)
+            threading.settrace(None)
+
+    def get_data(self):
+        return TracerData(dict(self.lines))
+
+    def close(self):
+        if self.monitoring and self.tool_id is not None:
+            self.monitoring.set_events(self.tool_id, 0)
+            for event in self.monitoring_callbacks:
+                self.monitoring.register_callback(self.tool_id, event, None)
+            self.monitoring.free_tool_id(self.tool_id)
+            self.tool_id = None
+
+    def _start_monitoring(self):
+        monitoring = self.monitoring
+        if self.tool_id is None:
+            for tool_id in (monitoring.COVERAGE_ID, monitoring.PROFILER_ID, 3, 4):
+                if monitoring.get_tool(tool_id) is None:
+                    monitoring.use_tool_id(tool_id, 'testmon')
+                    self.tool_id = tool_id
+                    break
+            else:
+                raise RuntimeError("testmon: no free sys.monitoring tool id")
+            for event, callback in self.monitoring_callbacks.items():
+                monitoring.register_callback(self.tool_id, event, callback)
+        # events disabled during the previous test have to be recorded again
+        monitoring.restart_events()
+        monitoring.set_events(self.tool_id, functools.reduce(operator.or_, self.monitoring_callbacks))
+
+    @property
+    def monitoring_callbacks(self):
+        events = self.monitoring.events
+        if self.mode == 'lines':
+            return {events.LINE: self._monitoring_line, events.PY_START: self._monitoring_start}
+        return {events.PY_START: self._monitoring_start}
+
+    def _monitoring_line(self, code, line_number):
+        filename = self.tracked_filename(code)
+        if filename is not None:
+            self.lines[filename].add(line_number)
+        return self.monitoring.DISABLE
+
+    def _monitoring_start(self, code, instruction_offset):
+        self._record_entry(code)
+        return self.monitoring.DISABLE
+
+    def _record_entry(self, code):
+        filename = self.tracked_filename(code)
+        if filename is not None:
+            if code not in self.entry_lines:
+                lines = body_lines(code)
+                # in 'lines' mode LINE events record the rest
+                self.entry_lines[code] = lines if self.mode == 'functions' else frozenset([min(lines)])
+            self.lines[filename].update(self.entry_lines[code])
+
+    def _settrace_function(self, frame, event, arg):
+        self._record_entry(frame.f_code)
+        return None
+
+    def _settrace_call(self, frame, event, arg):
+        code = frame.f_code
+        filename = self.tracked_filename(code)
+        if filename is None:
+            return None
+        if code not in self.remaining:
+            if code not in self.code_lines:
+                self.code_lines[code] = traced_lines(code)
+            self.remaining[code] = self.code_lines[code] - self.lines.get(filename, set())
+        remaining = self.remaining[code]
+        if not remaining:
+            return None
+        lines = self.lines[filename]
+
+        def trace_line(frame, event, arg):
+            if event == 'line':
+                lineno = frame.f_lineno
+                if lineno in remaining:
+                    remaining.discard(lineno)
+                    lines.add(lineno)
+                    if not remaining:
+                        return None
+            return trace_line
+
+        return trace_line